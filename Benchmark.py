@@ -0,0 +1,242 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import Environment
+import Feature
+import Resort
+from DataBaseConnection import DataBaseConnection, PROFILES
+from DAOFactoryMethod import ResortDAO, ResortDAOFactory, FeatureDAOFactory, EnvironmentDAOFactory, RoleDAOFactory, \
+    add, get_all, filter
+from GroupCommit import GroupCommitWriter
+from PriceIndex import PriceIndex
+from SimilarityIndex import SimilarityIndex
+
+
+FEATURES = ["spa", "golf", "water_park", "kids_club", "casino", "diving"]
+ENVIRONMENTS = ["savannah", "ocean", "mountain", "lake", "desert"]
+
+
+def seed(dbcon: DataBaseConnection, n_resorts: int):
+    add(FeatureDAOFactory(dbcon), [Feature.Feature(name) for name in FEATURES])
+    add(EnvironmentDAOFactory(dbcon), [Environment.Environment(name) for name in ENVIRONMENTS])
+    resorts = list()
+    for i in range(n_resorts):
+        resorts.append(Resort.Resort(f"resort_{i}", 1000.0 + (i * 7919) % 50000,
+                                     {FEATURES[i % len(FEATURES)], FEATURES[(i // 3) % len(FEATURES)]},
+                                     {ENVIRONMENTS[i % len(ENVIRONMENTS)]}))
+    add(ResortDAOFactory(dbcon), resorts)
+
+
+def bulk_seed(dbcon: DataBaseConnection, n_resorts: int):
+    # direct inserts for benchmarks that need far more rows than DAO.add can produce quickly
+    seed(dbcon, 0)
+    con = dbcon.get_connection()
+    with con:
+        con.executemany("insert into resorts (id, name, price) values (?, ?, ?)",
+                        ((i, f"resort_{i}", 1000.0 + (i * 7919) % 50000) for i in range(1, n_resorts + 1)))
+        con.executemany("insert into resort_features (resort_id, feature_id) values (?, ?)",
+                        ((i, 1 + (i * 31) % len(FEATURES)) for i in range(1, n_resorts + 1)))
+        con.executemany("insert into resort_environments (resort_id, environment_id) values (?, ?)",
+                        ((i, 1 + (i * 17) % len(ENVIRONMENTS)) for i in range(1, n_resorts + 1)))
+
+
+def bulk_seed_sets(dbcon: DataBaseConnection, n_resorts: int, n_features: int = 40, n_environments: int = 12):
+    # like bulk_seed, with random feature/environment sets drawn from a wider vocabulary
+    generator = random.Random(n_resorts)
+    add(FeatureDAOFactory(dbcon), [Feature.Feature(f"feature_{i}") for i in range(n_features)])
+    add(EnvironmentDAOFactory(dbcon), [Environment.Environment(f"environment_{i}") for i in range(n_environments)])
+    con = dbcon.get_connection()
+    with con:
+        con.executemany("insert into resorts (id, name, price) values (?, ?, ?)",
+                        ((i, f"resort_{i}", generator.uniform(500.0, 50000.0)) for i in range(1, n_resorts + 1)))
+        con.executemany("insert into resort_features (resort_id, feature_id) values (?, ?)",
+                        ((i, feature_id) for i in range(1, n_resorts + 1)
+                         for feature_id in generator.sample(range(1, n_features + 1), generator.randint(2, 6))))
+        con.executemany("insert into resort_environments (resort_id, environment_id) values (?, ?)",
+                        ((i, environment_id) for i in range(1, n_resorts + 1)
+                         for environment_id in generator.sample(range(1, n_environments + 1), generator.randint(1, 2))))
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_profiles(n_resorts: int = 2000, n_reads: int = 200):
+    dbcon = DataBaseConnection.get_instance()
+    resortDAOFactory = ResortDAOFactory(dbcon)
+    params = [{"column": "price", "value": 9000.0, "op": "<"}]
+
+    print(f"{'profile':<12}{'write s':>10}{'writes/s':>12}{'read s':>10}{'reads/s':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in PROFILES:
+            db_file_path = os.path.join(directory, f"{profile}.db")
+            # read-only cannot seed itself: load durably, then switch
+            load_profile = "durable" if profile == "read-only" else profile
+            dbcon.open_connection(db_file_path, reinit_file=True, profile=load_profile)
+            dbcon.init_tables()
+            write_time = timed(seed, dbcon, n_resorts)
+
+            dbcon.set_profile(profile)
+            read_time = timed(lambda: [filter(resortDAOFactory, params) for _ in range(n_reads)])
+            assert len(get_all(resortDAOFactory)) == n_resorts
+            dbcon.close_connection()
+
+            write_label = "-" if profile == "read-only" else f"{write_time:.3f}"
+            write_rate = "-" if profile == "read-only" else f"{n_resorts / write_time:.0f}"
+            print(f"{profile:<12}{write_label:>10}{write_rate:>12}{read_time:>10.3f}{n_reads / read_time:>12.0f}")
+
+
+def benchmark_price_index(n_resorts: int = 100000, n_queries: int = 200):
+    dbcon = DataBaseConnection.get_instance()
+    resortDAOFactory = ResortDAOFactory(dbcon)
+    with tempfile.TemporaryDirectory() as directory:
+        dbcon.open_connection(os.path.join(directory, "price_index.db"), reinit_file=True, profile="bulk-load")
+        dbcon.init_tables()
+        bulk_seed(dbcon, n_resorts)
+        dbcon.set_profile("balanced")
+
+        index = PriceIndex(dbcon)
+        build_time = timed(index.load)
+        print(f"build {n_resorts} resorts: {build_time:.3f}s, "
+              f"{index.memory_bytes() / 2 ** 20:.1f} MiB, {index.memory_per_million() / 2 ** 20:.1f} MiB per million")
+
+        params = [{"column": "price", "value": 9000.0, "op": "<"}]
+        sql_time = timed(lambda: [filter(resortDAOFactory, params) for _ in range(n_queries)])
+        index_time = timed(lambda: [index.range(high=9000.0) for _ in range(n_queries)])
+        print(f"price < 9000:   sql {sql_time / n_queries * 1000:.3f} ms   index {index_time / n_queries * 1000:.3f} ms")
+
+        con = dbcon.get_connection()
+        statement = """select resorts.id, resorts.price from resorts
+            join resort_features on resort_features.resort_id = resorts.id
+            join features on features.id = resort_features.feature_id
+            where features.name = 'spa' order by resorts.price limit 10"""
+        sql_time = timed(lambda: [con.execute(statement).fetchall() for _ in range(n_queries)])
+        index_time = timed(lambda: [index.cheapest(10, ["spa"]) for _ in range(n_queries)])
+        print(f"10 cheapest spa: sql {sql_time / n_queries * 1000:.3f} ms   index {index_time / n_queries * 1000:.3f} ms")
+        dbcon.close_connection()
+
+
+def benchmark_startup(n_restarts: int = 50):
+    dbcon = DataBaseConnection.get_instance()
+    with tempfile.TemporaryDirectory() as directory:
+        db_file_path = os.path.join(directory, "startup.db")
+        durations = list()
+        for restart in range(n_restarts):
+            start = time.perf_counter()
+            dbcon.open_connection(db_file_path, reinit_file=restart == 0)
+            dbcon.init_tables()
+            durations.append(time.perf_counter() - start)
+            roles = len(get_all(RoleDAOFactory(dbcon)))
+            dbcon.close_connection()
+
+        steady = sorted(durations[1:]) or durations
+        print(f"first start (migrations): {durations[0] * 1000:.3f} ms")
+        print(f"restarts: median {steady[len(steady) // 2] * 1000:.3f} ms, max {steady[-1] * 1000:.3f} ms")
+        print(f"roles after {n_restarts} starts: {roles}")
+
+
+def benchmark_group_commit(n_writes: int = 2000, n_threads: int = 8):
+    dbcon = DataBaseConnection.get_instance()
+    with tempfile.TemporaryDirectory() as directory:
+        db_file_path = os.path.join(directory, "group_commit.db")
+        dbcon.open_connection(db_file_path, reinit_file=True)
+        dbcon.init_tables()
+        seed(dbcon, 0)
+
+        resortDAOFactory = ResortDAOFactory(dbcon)
+        resorts = [Resort.Resort(f"direct_{i}", 1000.0 + i, {"spa"}, {"ocean"}) for i in range(n_writes)]
+        direct_time = timed(add, resortDAOFactory, resorts)
+        dbcon.close_connection()
+
+        resorts = [Resort.Resort(f"grouped_{i}", 1000.0 + i, {"spa"}, {"ocean"}) for i in range(n_writes)]
+        with GroupCommitWriter(db_file_path) as writer:
+            def submit_all():
+                with ThreadPoolExecutor(n_threads) as executor:
+                    futures = list(executor.map(lambda resort: writer.add(ResortDAO, resort), resorts))
+                for future in futures:
+                    future.result()
+
+            grouped_time = timed(submit_all)
+            batches = writer.batches
+
+        print(f"one transaction per write: {n_writes / direct_time:.0f} writes/s")
+        print(f"group commit, {n_threads} threads: {n_writes / grouped_time:.0f} writes/s in {batches} batches")
+
+
+def benchmark_similarity(n_resorts: int = 1000000, n_queries: int = 20, k: int = 10, num_perm: int = 48,
+                         bands: int = 16):
+    dbcon = DataBaseConnection.get_instance()
+    with tempfile.TemporaryDirectory() as directory:
+        dbcon.open_connection(os.path.join(directory, "similarity.db"), reinit_file=True, profile="bulk-load")
+        dbcon.init_tables()
+        bulk_seed_sets(dbcon, n_resorts)
+        dbcon.set_profile("balanced")
+
+        index = SimilarityIndex(dbcon, num_perm, bands)
+        build_time = timed(index.load)
+        dbcon.close_connection()
+    print(f"build {n_resorts} resorts: {build_time:.3f}s, "
+          f"{index.memory_bytes() / 2 ** 20:.1f} MiB, {index.memory_per_million() / 2 ** 20:.1f} MiB per million")
+
+    ids = random.Random(k).sample(range(1, n_resorts + 1), n_queries)
+    latencies, exact_latencies, hits = list(), list(), 0
+    for id_ in ids:
+        start = time.perf_counter()
+        found = index.similar(id_, k)
+        latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        expected = index.similar_exact(id_, k)
+        exact_latencies.append(time.perf_counter() - start)
+        hits += len({row[2] for row in found} & {row[2] for row in expected})
+
+    latencies.sort()
+    exact_latencies.sort()
+    print(f"lsh:   p50 {latencies[len(latencies) // 2] * 1000:.3f} ms   p99 "
+          f"{latencies[min(len(latencies) - 1, int(.99 * len(latencies)))] * 1000:.3f} ms")
+    print(f"exact: p50 {exact_latencies[len(exact_latencies) // 2] * 1000:.3f} ms")
+    print(f"recall@{k}: {hits / (k * n_queries):.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DAO layer benchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    profiles_parser = subparsers.add_parser("profiles", help="write/read throughput per connection profile")
+    profiles_parser.add_argument("--resorts", type=int, default=2000)
+    profiles_parser.add_argument("--reads", type=int, default=200)
+
+    price_index_parser = subparsers.add_parser("price-index", help="PriceIndex against SQL range and top-k queries")
+    price_index_parser.add_argument("--resorts", type=int, default=100000)
+    price_index_parser.add_argument("--queries", type=int, default=200)
+
+    startup_parser = subparsers.add_parser("startup", help="open_connection + init_tables across restarts")
+    startup_parser.add_argument("--restarts", type=int, default=50)
+
+    group_commit_parser = subparsers.add_parser("group-commit", help="per-write transactions against GroupCommitWriter")
+    group_commit_parser.add_argument("--writes", type=int, default=2000)
+    group_commit_parser.add_argument("--threads", type=int, default=8)
+
+    similarity_parser = subparsers.add_parser("similarity", help="SimilarityIndex recall and latency against exact search")
+    similarity_parser.add_argument("--resorts", type=int, default=1000000)
+    similarity_parser.add_argument("--queries", type=int, default=20)
+    similarity_parser.add_argument("--k", type=int, default=10)
+    similarity_parser.add_argument("--num-perm", type=int, default=48)
+    similarity_parser.add_argument("--bands", type=int, default=16)
+
+    args = parser.parse_args()
+    if args.benchmark == "profiles":
+        benchmark_profiles(args.resorts, args.reads)
+    elif args.benchmark == "price-index":
+        benchmark_price_index(args.resorts, args.queries)
+    elif args.benchmark == "startup":
+        benchmark_startup(args.restarts)
+    elif args.benchmark == "group-commit":
+        benchmark_group_commit(args.writes, args.threads)
+    elif args.benchmark == "similarity":
+        benchmark_similarity(args.resorts, args.queries, args.k, args.num_perm, args.bands)
@@ -1,16 +1,40 @@
+import json
+import re
 import sqlite3
+import threading
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 import Environment
 import Feature
 from SubjectObserver import Subject, Observer, DAOUpdateObserver
-from DataBaseConnection import DataBaseConnection
+from DataBaseConnection import DataBaseConnection, REBUILD_RESORT_VIEW
+from Metrics import instrumented
 import Resort
 import Memento
 import User
 
 
+class ConcurrentUpdateError(Exception):
+    # a row changed (or vanished) between reading its version and writing it
+    def __init__(self, table: str, ids: list = ()):
+        super().__init__(f"Concurrent update on {table}: {list(ids)}.")
+        self.table = table
+        self.ids = list(ids)
+
+
+class DeadlineExceededError(Exception):
+    # a statement was aborted by deadline(); the connection is left usable
+    def __init__(self, timeout: float):
+        super().__init__(f"Deadline of {timeout:.3f}s exceeded.")
+        self.timeout = timeout
+
+
 class DAO(ABC):
+    _table: str = None
+    _columns: tuple = ()
+
     @abstractmethod
     def get_all(self) -> list:
         pass
@@ -31,6 +55,87 @@ class DAO(ABC):
     def update(self, object_old, object_new):
         pass
 
+    def versions(self, params: list) -> list:
+        # (id, version) of matching rows; pass version on object_old to update only that version
+        return select_for_update(self._dbcon.get_connection(), self._table, params)
+
+
+class SearchableDAO:
+    # full-text search over the `name` column through the <table>_fts index
+
+    @staticmethod
+    def _match_query(text: str, prefix: bool) -> str:
+        tokens = re.findall(r"\w+", text)
+        if not tokens:
+            return ""
+        terms = [f'"{token}"' for token in tokens]
+        if prefix:
+            terms[-1] += "*"
+        return " ".join(terms)
+
+    @instrumented
+    def search(self, text: str, limit: int = 10, prefix: bool = True) -> list:
+        query = self._match_query(text, prefix)
+        if not query:
+            return list()
+
+        con = self._dbcon.get_read_connection()
+        columns = ", ".join(f"{self._table}.{column}" for column in self._columns)
+        statement = f"""select {columns} from {self._table}_fts
+            join {self._table} on {self._table}.id = {self._table}_fts.rowid
+            where {self._table}_fts match :query order by rank limit :limit"""
+        found = list()
+        with con:
+            for row in con.execute(statement, {"query": query, "limit": limit}):
+                found.append(row)
+        return found
+
+    def rebuild_search_index(self):
+        # needed once for rows written before the index existed
+        con = self._dbcon.get_connection()
+        with con:
+            con.execute(f"insert into {self._table}_fts ({self._table}_fts) values ('rebuild')")
+
+
+class JSONReadDAO:
+    # reads encoded as a JSON array of objects by sqlite itself
+    _json_source: str = None
+    _json_object: str = None
+
+    def _json_statement(self, params: list) -> tuple:
+        where, query_params = where_clause(params)
+        return f"select {self._json_object} as object from {self._json_source}{where} order by id", query_params
+
+    @instrumented
+    def get_all_json(self) -> bytes:
+        return self.filter_json([])
+
+    @instrumented
+    def filter_json(self, params: list) -> bytes:
+        con = self._dbcon.get_read_connection()
+        statement, query_params = self._json_statement(params)
+        with con:
+            payload, = con.execute(f"select json_group_array(json(object)) from ({statement})",
+                                   query_params).fetchone()
+        return payload.encode()
+
+    def iterate_json(self, params: list = (), chunk_rows: int = 1000):
+        # the same array as filter_json, as byte chunks of up to chunk_rows objects
+        con = self._dbcon.get_read_connection()
+        statement, query_params = self._json_statement(list(params))
+        cursor = con.execute(statement, query_params)
+        try:
+            separator = b"["
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield separator + b",".join(row[0].encode() for row in rows)
+                separator = b","
+            yield b"[]" if separator == b"[" else b"]"
+        finally:
+            cursor.close()
+
 
 class DAOFactory(ABC):
     @abstractmethod
@@ -46,7 +151,10 @@ class ResortDAOFactory(DAOFactory):
         self._observer = observer
 
     def create_DAO(self) -> DAO:
-        dao = ResortDAO(self._dbcon)
+        if self._dbcon.sharded:
+            dao = self._dbcon.create_DAO(ResortDAO)
+        else:
+            dao = ResortDAO(self._dbcon)
         if self._observer:
             dao.attach(self._observer)
         return dao
@@ -60,7 +168,10 @@ class FeatureDAOFactory(DAOFactory):
         self._observer = observer
 
     def create_DAO(self) -> DAO:
-        dao = FeatureDAO(self._dbcon)
+        if self._dbcon.sharded:
+            dao = self._dbcon.create_DAO(FeatureDAO)
+        else:
+            dao = FeatureDAO(self._dbcon)
         if self._observer:
             dao.attach(self._observer)
         return dao
@@ -74,7 +185,10 @@ class EnvironmentDAOFactory(DAOFactory):
         self._observer = observer
 
     def create_DAO(self) -> DAO:
-        dao = EnvironmentDAO(self._dbcon)
+        if self._dbcon.sharded:
+            dao = self._dbcon.create_DAO(EnvironmentDAO)
+        else:
+            dao = EnvironmentDAO(self._dbcon)
         if self._observer:
             dao.attach(self._observer)
         return dao
@@ -85,6 +199,8 @@ class UserDAOFactory(DAOFactory):
         self._dbcon = dbcon
 
     def create_DAO(self) -> DAO:
+        if self._dbcon.sharded:
+            return self._dbcon.create_DAO(UserDAO)
         return UserDAO(self._dbcon)
 
 
@@ -93,6 +209,8 @@ class RoleDAOFactory(DAOFactory):
         self._dbcon = dbcon
 
     def create_DAO(self) -> DAO:
+        if self._dbcon.sharded:
+            return self._dbcon.create_DAO(RoleDAO)
         return RoleDAO(self._dbcon)
 
 
@@ -103,9 +221,32 @@ class DAOProxy(DAO):
         "user": -2
     }
 
-    def __init__(self, subject: DAO):
+    # default deadline per role, in seconds; None leaves calls unbounded
+    _budgets = {
+        "admin": 60.0,
+        "user": 2.0
+    }
+
+    def __init__(self, subject: DAO, budgets: dict = None, scheduler=None):
+        # scheduler: Scheduler.RoleScheduler shared by the proxies whose calls it orders
         self._subject = subject
         self._current_user_access = 0
+        self._budgets = dict(self._budgets, **(budgets or dict()))
+        self._budget = None
+        self._role = None
+        self._scheduler = scheduler
+
+    def _call(self, method: str, *args):
+        if self._scheduler is None:
+            with deadline(self._subject._dbcon, self._budget):
+                return getattr(self._subject, method)(*args)
+
+        # time spent queued counts against the role's budget
+        start = time.monotonic()
+        with self._scheduler.slot(self._role, self._budget):
+            budget = None if self._budget is None else max(self._budget - (time.monotonic() - start), .0)
+            with deadline(self._subject._dbcon, budget):
+                return getattr(self._subject, method)(*args)
 
     def login(self, login: str, password: str) -> bool:
         current_user = filter(UserDAOFactory(self._subject._dbcon),
@@ -123,6 +264,8 @@ class DAOProxy(DAO):
             }
             if User.User.hash_password(password) == current_user["phash"]:
                 self._current_user_access = self._access[current_user["role"]]
+                self._budget = self._budgets.get(current_user["role"])
+                self._role = current_user["role"]
                 return True
         return False
 
@@ -132,21 +275,46 @@ class DAOProxy(DAO):
     def get_all(self) -> list:
         if self.check_access():
             if self._current_user_access >= self._access["user"]:
-                return self._subject.get_all()
+                return self._call("get_all")
             else:
                 return list()
 
     def filter(self, params: list) -> list:
         if self.check_access():
             if self._current_user_access >= self._access["user"]:
-                return self._subject.filter(params)
+                return self._call("filter", params)
+            else:
+                return list()
+
+    def versions(self, params: list) -> list:
+        if self.check_access():
+            if self._current_user_access >= self._access["user"]:
+                return self._call("versions", params)
             else:
                 return list()
 
     def add(self, object_):
         if self.check_access():
             if self._current_user_access >= self._access["admin"]:
-                return self._subject.add(object_)
+                return self._call("add", object_)
+            else:
+                raise PermissionError("Unauthorized.")
+        else:
+            raise PermissionError("No user logon.")
+
+    def upsert(self, object_):
+        if self.check_access():
+            if self._current_user_access >= self._access["admin"]:
+                return self._call("upsert", object_)
+            else:
+                raise PermissionError("Unauthorized.")
+        else:
+            raise PermissionError("No user logon.")
+
+    def upsert_many(self, objects: list):
+        if self.check_access():
+            if self._current_user_access >= self._access["admin"]:
+                return self._call("upsert_many", objects)
             else:
                 raise PermissionError("Unauthorized.")
         else:
@@ -155,7 +323,7 @@ class DAOProxy(DAO):
     def remove(self, object_):
         if self.check_access():
             if self._current_user_access >= self._access["admin"]:
-                return self._subject.remove(object_)
+                return self._call("remove", object_)
             else:
                 raise PermissionError("Unauthorized.")
         else:
@@ -164,7 +332,7 @@ class DAOProxy(DAO):
     def update(self, object_old, object_new):
         if self.check_access():
             if self._current_user_access >= self._access["admin"]:
-                return self._subject.update(object_old, object_new)
+                return self._call("update", object_old, object_new)
             else:
                 raise PermissionError("Unauthorized.")
         else:
@@ -172,28 +340,32 @@ class DAOProxy(DAO):
 
 
 class RoleDAO(DAO):
+    _table: str = "roles"
+    _columns: tuple = ("id", "name")
 
     _: DataBaseConnection = None
 
     def __init__(self, dbcon: DataBaseConnection = None):
         self._dbcon = dbcon
 
+    @instrumented
     def get_all(self) -> list:
         con = self._dbcon.get_connection()
-        statement = """select * from roles;"""
+        statement = """select id, name from roles order by id;"""
         all = list()
         with con:
             for row in con.execute(statement):
                 all.append(row)
         return all
 
+    @instrumented
     def filter(self, params: list) -> list:
         con = self._dbcon.get_connection()
         if any(params):
-            base_statement = """select * from roles where """
-            param_statements = [f"{param['column']}{param['op']}:{param['column']}" for param in params]
+            base_statement = """select id, name from roles where """
+            param_statements = [f"{param['column']}{param['op']}:p{i}" for i, param in enumerate(params)]
             final_statement = base_statement + " and ".join(param_statements)
-            query_params = {param["column"]: param["value"] for param in params}
+            query_params = {f"p{i}": param["value"] for i, param in enumerate(params)}
             filtered = list()
             with con:
                 exec = con.execute(final_statement, query_params)
@@ -203,6 +375,7 @@ class RoleDAO(DAO):
         else:
             return self.get_all()
 
+    @instrumented
     def add(self, role: str):
         con = self._dbcon.get_connection()
         base_statement = """insert into roles (name) values (?)"""
@@ -210,6 +383,19 @@ class RoleDAO(DAO):
         with con:
             con.execute(base_statement, (role,))
 
+    @instrumented
+    def upsert(self, role: str) -> int:
+        return self.upsert_many([role])[role]
+
+    @instrumented
+    def upsert_many(self, roles: list) -> dict:
+        # name -> id, inserting the missing roles in one transaction
+        con = self._dbcon.get_connection()
+        with con:
+            ids, _ = upsert_names(con, "roles", roles)
+        return ids
+
+    @instrumented
     def remove(self, object_):
         con = self._dbcon.get_connection()
         base_statement = """delete from roles where id=:id"""
@@ -226,9 +412,10 @@ class RoleDAO(DAO):
             for td in to_delete:
                 con.execute(base_statement, {"id": td[0]})
 
+    @instrumented
     def update(self, object_old: Feature.Feature, object_new: Feature.Feature):
         con = self._dbcon.get_connection()
-        base_statement = """update roles set name=:name where id=:id"""
+        base_statement = """update roles set name=:name, version=version + 1 where id=:id and version=:version"""
         update_cond = [
             {
                 "column": "name",
@@ -236,23 +423,30 @@ class RoleDAO(DAO):
                 "op": "="
             }
         ]
-        to_update = self.filter(update_cond)
+        to_update = select_for_update(con, "roles", update_cond, object_old)
 
         with con:
             for tu in to_update:
-                con.execute(base_statement, {
+                cursor = con.execute(base_statement, {
                     "id": tu[0],
-                    "name": object_new.name
+                    "name": object_new.name,
+                    "version": tu[1]
                 })
+                if not cursor.rowcount:
+                    raise ConcurrentUpdateError("roles", [tu[0]])
 
 
-class UserDAO(DAO):
-
+class UserDAO(DAO, Subject):
+    _table: str = "users"
+    _columns: tuple = ("login", "role", "phash")
+    _last_action: dict = None
+    _observers: list = list()
     _dbcon: DataBaseConnection = None
 
     def __init__(self, dbcon: DataBaseConnection):
         self._dbcon = dbcon
 
+    @instrumented
     def get_all(self) -> list:
         con = self._dbcon.get_connection()
         statement = """select login, roles.role role, phash from users join roles on roles.id = users.role_id;"""
@@ -262,13 +456,16 @@ class UserDAO(DAO):
                 all.append(row)
         return all
 
+    @instrumented
     def filter(self, params: list) -> list:
+        if definite_miss(self._dbcon, "users", params):
+            return list()
         con = self._dbcon.get_connection()
         if any(params):
             base_statement = """select login, roles.name role, phash from users join roles on roles.id = users.role_id where """
-            param_statements = [f"{param['column']}{param['op']}:{param['column']}" for param in params]
+            param_statements = [f"{param['column']}{param['op']}:p{i}" for i, param in enumerate(params)]
             final_statement = base_statement + " and ".join(param_statements)
-            query_params = {param["column"]: param["value"] for param in params}
+            query_params = {f"p{i}": param["value"] for i, param in enumerate(params)}
             filtered = list()
             with con:
                 exec = con.execute(final_statement, query_params)
@@ -279,6 +476,7 @@ class UserDAO(DAO):
             return self.get_all()
         pass
 
+    @instrumented
     def add(self, object_: User.User):
         con = self._dbcon.get_connection()
 
@@ -296,6 +494,13 @@ class UserDAO(DAO):
             cursor = con.cursor()
             cursor.execute(bs_users, (role_id, object_.login, object_.password))
 
+        self._last_action = {
+            "action": "add",
+            "object": object_
+        }
+        self.notify()
+
+    @instrumented
     def remove(self, object_):
         con = self._dbcon.get_connection()
         base_statement = """delete from users where id=:id"""
@@ -312,17 +517,25 @@ class UserDAO(DAO):
             for td in to_delete:
                 con.execute(base_statement, {"id": td[0]})
 
+        self._last_action = {
+            "action": "remove",
+            "object": object_
+        }
+        self.notify()
+
+    @instrumented
     def update(self, object_old: User.User, object_new: User.User):
         con = self._dbcon.get_connection()
-        base_statement = """update users set role_id=:role_id, login=:login, phash=:phash where id=:id"""
+        base_statement = """update users set role_id=:role_id, login=:login, phash=:phash, version=version + 1
+            where id=:id and version=:version"""
         update_cond = [
             {
-                "column": "name",
+                "column": "login",
                 "value": object_old.login,
                 "op": "="
             }
         ]
-        to_update = self.filter(update_cond)
+        to_update = select_for_update(con, "users", update_cond, object_old)
 
         avail_roles = get_all(RoleDAOFactory(self._dbcon))
         avail_roles_dct = {role: id_ for id_, role in avail_roles}
@@ -334,15 +547,40 @@ class UserDAO(DAO):
 
         with con:
             for tu in to_update:
-                con.execute(base_statement, {
+                cursor = con.execute(base_statement, {
                     "id": tu[0],
                     "role_id": role_id,
                     "login": object_new.login,
-                    "phash": object_new.password
+                    "phash": object_new.password,
+                    "version": tu[1]
                 })
+                if not cursor.rowcount:
+                    raise ConcurrentUpdateError("users", [tu[0]])
 
+        self._last_action = {
+            "action": "update",
+            "old": object_old,
+            "new": object_new
+        }
+        self.notify()
+
+    def attach(self, observer: Observer) -> None:
+        self._observers.append(observer)
+
+    def detach(self, observer: Observer) -> None:
+        self._observers.remove(observer)
+
+    def notify(self) -> None:
+        for observer in self._observers:
+            observer.update(self)
 
-class ResortDAO(DAO, Subject):
+
+class ResortDAO(DAO, Subject, SearchableDAO, JSONReadDAO):
+    _table: str = "resorts"
+    _columns: tuple = ("id", "name", "price")
+    _json_source: str = "resort_view"
+    _json_object: str = ("json_object('id', id, 'name', name, 'price', price, "
+                         "'features', json(features), 'environments', json(environments))")
     _last_action: dict = None
     _observers: list = list()
     _dbcon: DataBaseConnection = None
@@ -350,22 +588,26 @@ class ResortDAO(DAO, Subject):
     def __init__(self, dbcon: DataBaseConnection = None):
         self._dbcon = dbcon
 
+    @instrumented
     def get_all(self) -> list:
-        con = self._dbcon.get_connection()
-        statement = """select * from resorts;"""
+        con = self._dbcon.get_read_connection()
+        statement = """select id, name, price from resorts;"""
         all = list()
         with con:
             for row in con.execute(statement):
                 all.append(row)
         return all
 
+    @instrumented
     def filter(self, params: list) -> list:
-        con = self._dbcon.get_connection()
+        if definite_miss(self._dbcon, "resorts", params):
+            return list()
+        con = self._dbcon.get_read_connection()
         if any(params):
-            base_statement = """select * from resorts where """
-            param_statements = [f"{param['column']}{param['op']}:{param['column']}" for param in params]
+            base_statement = """select id, name, price from resorts where """
+            param_statements = [f"{param['column']}{param['op']}:p{i}" for i, param in enumerate(params)]
             final_statement = base_statement + " and ".join(param_statements)
-            query_params = {param["column"]: param["value"] for param in params}
+            query_params = {f"p{i}": param["value"] for i, param in enumerate(params)}
             filtered = list()
             with con:
                 exec = con.execute(final_statement, query_params)
@@ -375,6 +617,53 @@ class ResortDAO(DAO, Subject):
         else:
             return self.get_all()
 
+    @instrumented
+    def get_all_view(self) -> list:
+        # served from resort_view: (id, name, price, [features], [environments])
+        return self.filter_view([])
+
+    @instrumented
+    def filter_view(self, params: list) -> list:
+        con = self._dbcon.get_read_connection()
+        where, query_params = where_clause(params)
+        statement = f"""select id, name, price, features, environments from resort_view{where}"""
+        filtered = list()
+        with con:
+            for id_, name, price, features, environments in con.execute(statement, query_params):
+                filtered.append((id_, name, price, json.loads(features), json.loads(environments)))
+        return filtered
+
+    def rebuild_view(self):
+        # recovery: recompute every resort_view row from the base tables
+        con = self._dbcon.get_connection()
+        with con:
+            for statement in REBUILD_RESORT_VIEW:
+                con.execute(statement)
+
+    def iterate_with_names(self, batch_size: int = 1000):
+        # single cursor, one row per resort: (id, name, price, [features], [environments])
+        con = self._dbcon.get_read_connection()
+        statement = """
+            select resorts.id, resorts.name, resorts.price,
+                (select json_group_array(features.name) from resort_features
+                    join features on features.id = resort_features.feature_id
+                    where resort_features.resort_id = resorts.id),
+                (select json_group_array(environments.name) from resort_environments
+                    join environments on environments.id = resort_environments.environment_id
+                    where resort_environments.resort_id = resorts.id)
+            from resorts order by resorts.id;"""
+        cursor = con.execute(statement)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for id_, name, price, features, environments in rows:
+                    yield id_, name, price, json.loads(features), json.loads(environments)
+        finally:
+            cursor.close()
+
+    @instrumented
     def add(self, resort: Resort.Resort):
         con = self._dbcon.get_connection()
 
@@ -382,10 +671,8 @@ class ResortDAO(DAO, Subject):
         bs_resort_features = """insert into resort_features (resort_id, feature_id) values (?, ?)"""
         bs_resort_environments = """insert into resort_environments (resort_id, environment_id) values (?, ?)"""
 
-        avail_features = get_all(FeatureDAOFactory(self._dbcon))
-        avail_features_dct = {feature: id_ for id_, feature in avail_features}
-        avail_environments = get_all(EnvironmentDAOFactory(self._dbcon))
-        avail_environments_dct = {environment: id_ for id_, environment in avail_environments}
+        avail_features_dct = name_ids(con, "features", list(resort.feature_ids))
+        avail_environments_dct = name_ids(con, "environments", list(resort.environment_ids))
 
         with con:
             cursor = con.cursor()
@@ -408,10 +695,70 @@ class ResortDAO(DAO, Subject):
 
         self._last_action = {
             "action": "add",
-            "object": resort
+            "object": resort,
+            "id": resort_id
         }
         self.notify()
 
+    @instrumented
+    def upsert(self, resort: Resort.Resort) -> int:
+        return self.upsert_many([resort])[resort.name]
+
+    @instrumented
+    def upsert_many(self, resorts: list) -> dict:
+        # name -> id in one transaction: new names are inserted, existing ones take the resort's price,
+        # features and environments; observers see every inserted or changed resort as an add of its id
+        con = self._dbcon.get_connection()
+        bs_resort = """insert into resorts (name, price) values (:name, :price)
+            on conflict(name) do update set price=excluded.price, version=version + 1
+            where price is not excluded.price
+            returning id"""
+        bs_unlink = """delete from {link} where resort_id=:id and {key} not in (select value from json_each(:ids))"""
+        bs_link = """insert into {link} (resort_id, {key}) select :id, value from json_each(:ids) where true
+            on conflict do nothing"""
+
+        ids = dict()
+        changed = list()
+        with con:
+            avail_features_dct = name_ids(con, "features", list({name for resort in resorts
+                                                                  for name in resort.feature_ids}))
+            avail_environments_dct = name_ids(con, "environments", list({name for resort in resorts
+                                                                          for name in resort.environment_ids}))
+            for resort in resorts:
+                try:
+                    links = (
+                        ("resort_features", "feature_id",
+                         [avail_features_dct[name] for name in resort.feature_ids]),
+                        ("resort_environments", "environment_id",
+                         [avail_environments_dct[name] for name in resort.environment_ids])
+                    )
+                except KeyError:
+                    raise sqlite3.IntegrityError()
+
+                changes = con.total_changes
+                returned = con.execute(bs_resort, {"name": resort.name, "price": resort.price}).fetchall()
+                if returned:
+                    resort_id = returned[0][0]
+                else:
+                    resort_id, = con.execute("select id from resorts where name=?", (resort.name,)).fetchone()
+                for link, key, link_ids in links:
+                    link_params = {"id": resort_id, "ids": json.dumps(link_ids)}
+                    con.execute(bs_unlink.format(link=link, key=key), link_params)
+                    con.execute(bs_link.format(link=link, key=key), link_params)
+                ids[resort.name] = resort_id
+                if con.total_changes != changes:
+                    changed.append((resort_id, resort))
+
+        for resort_id, resort in changed:
+            self._last_action = {
+                "action": "add",
+                "object": resort,
+                "id": resort_id
+            }
+            self.notify()
+        return ids
+
+    @instrumented
     def remove(self, object_):
         con = self._dbcon.get_connection()
         base_statement = """delete from resorts where id=:id"""
@@ -427,7 +774,7 @@ class ResortDAO(DAO, Subject):
                 "op": "="
             }
         ]
-        to_delete = self.filter(delete_cond)
+        to_delete = select_for_update(con, "resorts", delete_cond)
 
         with con:
             for td in to_delete:
@@ -435,13 +782,16 @@ class ResortDAO(DAO, Subject):
 
         self._last_action = {
             "action": "remove",
-            "object": object_
+            "object": object_,
+            "ids": [td[0] for td in to_delete]
         }
         self.notify()
 
+    @instrumented
     def update(self, object_old: Resort.Resort, object_new: Resort.Resort):
         con = self._dbcon.get_connection()
-        base_statement = """update resorts set name=:name, price=:price where id=:id"""
+        base_statement = """update resorts set name=:name, price=:price, version=version + 1
+            where id=:id and version=:version"""
 
         update_cond = [
             {
@@ -455,20 +805,24 @@ class ResortDAO(DAO, Subject):
                 "op": "="
             }
         ]
-        to_update = self.filter(update_cond)
+        to_update = select_for_update(con, "resorts", update_cond, object_old)
 
         with con:
             for tu in to_update:
-                con.execute(base_statement, {
+                cursor = con.execute(base_statement, {
                     "id": tu[0],
                     "name": object_new.name,
                     "price": object_new.price,
+                    "version": tu[1]
                 })
+                if not cursor.rowcount:
+                    raise ConcurrentUpdateError("resorts", [tu[0]])
 
         self._last_action = {
             "action": "update",
             "old": object_old,
-            "new": object_new
+            "new": object_new,
+            "ids": [tu[0] for tu in to_update]
         }
         self.notify()
 
@@ -493,7 +847,11 @@ class ResortDAO(DAO, Subject):
             raise NotImplementedError
 
 
-class FeatureDAO(DAO, Subject):
+class FeatureDAO(DAO, Subject, SearchableDAO, JSONReadDAO):
+    _table: str = "features"
+    _columns: tuple = ("id", "name")
+    _json_source: str = "features"
+    _json_object: str = "json_object('id', id, 'name', name)"
     _last_action: dict = None
     _observers: list = list()
     _dbcon: DataBaseConnection = None
@@ -501,22 +859,26 @@ class FeatureDAO(DAO, Subject):
     def __init__(self, dbcon: DataBaseConnection = None):
         self._dbcon = dbcon
 
+    @instrumented
     def get_all(self) -> list:
-        con = self._dbcon.get_connection()
-        statement = """select * from features;"""
+        con = self._dbcon.get_read_connection()
+        statement = """select id, name from features order by id;"""
         all = list()
         with con:
             for row in con.execute(statement):
                 all.append(row)
         return all
 
+    @instrumented
     def filter(self, params: list) -> list:
-        con = self._dbcon.get_connection()
+        if definite_miss(self._dbcon, "features", params):
+            return list()
+        con = self._dbcon.get_read_connection()
         if any(params):
-            base_statement = """select * from features where """
-            param_statements = [f"{param['column']}{param['op']}:{param['column']}" for param in params]
+            base_statement = """select id, name from features where """
+            param_statements = [f"{param['column']}{param['op']}:p{i}" for i, param in enumerate(params)]
             final_statement = base_statement + " and ".join(param_statements)
-            query_params = {param["column"]: param["value"] for param in params}
+            query_params = {f"p{i}": param["value"] for i, param in enumerate(params)}
             filtered = list()
             with con:
                 exec = con.execute(final_statement, query_params)
@@ -526,6 +888,7 @@ class FeatureDAO(DAO, Subject):
         else:
             return self.get_all()
 
+    @instrumented
     def add(self, feature: Feature.Feature):
         con = self._dbcon.get_connection()
         base_statement = """insert into features (name) values (?)"""
@@ -539,6 +902,26 @@ class FeatureDAO(DAO, Subject):
         }
         self.notify()
 
+    @instrumented
+    def upsert(self, feature: Feature.Feature) -> int:
+        return self.upsert_many([feature])[feature.name]
+
+    @instrumented
+    def upsert_many(self, features: list) -> dict:
+        # name -> id, inserting the missing features in one transaction; observers see each insert as an add
+        con = self._dbcon.get_connection()
+        with con:
+            ids, inserted = upsert_names(con, "features", [feature.name for feature in features])
+        by_name = {feature.name: feature for feature in features}
+        for name in inserted:
+            self._last_action = {
+                "action": "add",
+                "object": by_name[name]
+            }
+            self.notify()
+        return ids
+
+    @instrumented
     def remove(self, object_):
         con = self._dbcon.get_connection()
         base_statement = """delete from features where id=:id"""
@@ -549,7 +932,7 @@ class FeatureDAO(DAO, Subject):
                 "op": "="
             }
         ]
-        to_delete = self.filter(delete_cond)
+        to_delete = select_for_update(con, "features", delete_cond)
 
         with con:
             for td in to_delete:
@@ -561,9 +944,10 @@ class FeatureDAO(DAO, Subject):
         }
         self.notify()
 
+    @instrumented
     def update(self, object_old: Feature.Feature, object_new: Feature.Feature):
         con = self._dbcon.get_connection()
-        base_statement = """update features set name=:name where id=:id"""
+        base_statement = """update features set name=:name, version=version + 1 where id=:id and version=:version"""
         update_cond = [
             {
                 "column": "name",
@@ -571,14 +955,17 @@ class FeatureDAO(DAO, Subject):
                 "op": "="
             }
         ]
-        to_update = self.filter(update_cond)
+        to_update = select_for_update(con, "features", update_cond, object_old)
 
         with con:
             for tu in to_update:
-                con.execute(base_statement, {
+                cursor = con.execute(base_statement, {
                     "id": tu[0],
-                    "name": object_new.name
+                    "name": object_new.name,
+                    "version": tu[1]
                 })
+                if not cursor.rowcount:
+                    raise ConcurrentUpdateError("features", [tu[0]])
 
         self._last_action = {
             "action": "update",
@@ -598,7 +985,11 @@ class FeatureDAO(DAO, Subject):
             observer.update(self)
 
 
-class EnvironmentDAO(DAO, Subject):
+class EnvironmentDAO(DAO, Subject, SearchableDAO, JSONReadDAO):
+    _table: str = "environments"
+    _columns: tuple = ("id", "name")
+    _json_source: str = "environments"
+    _json_object: str = "json_object('id', id, 'name', name)"
     _last_action: dict = None
     _observers: list = list()
     _dbcon: DataBaseConnection = None
@@ -606,22 +997,26 @@ class EnvironmentDAO(DAO, Subject):
     def __init__(self, dbcon: DataBaseConnection = None):
         self._dbcon = dbcon
 
+    @instrumented
     def get_all(self) -> list:
-        con = self._dbcon.get_connection()
-        statement = """select * from environments;"""
+        con = self._dbcon.get_read_connection()
+        statement = """select id, name from environments order by id;"""
         all = list()
         with con:
             for row in con.execute(statement):
                 all.append(row)
         return all
 
+    @instrumented
     def filter(self, params: list) -> list:
-        con = self._dbcon.get_connection()
+        if definite_miss(self._dbcon, "environments", params):
+            return list()
+        con = self._dbcon.get_read_connection()
         if any(params):
-            base_statement = """select * from environments where """
-            param_statements = [f"{param['column']}{param['op']}:{param['column']}" for param in params]
+            base_statement = """select id, name from environments where """
+            param_statements = [f"{param['column']}{param['op']}:p{i}" for i, param in enumerate(params)]
             final_statement = base_statement + " and ".join(param_statements)
-            query_params = {param["column"]: param["value"] for param in params}
+            query_params = {f"p{i}": param["value"] for i, param in enumerate(params)}
             filtered = list()
             with con:
                 exec = con.execute(final_statement, query_params)
@@ -631,6 +1026,7 @@ class EnvironmentDAO(DAO, Subject):
         else:
             return self.get_all()
 
+    @instrumented
     def add(self, environment: Environment.Environment):
         con = self._dbcon.get_connection()
         base_statement = """insert into environments (name) values (?)"""
@@ -644,6 +1040,26 @@ class EnvironmentDAO(DAO, Subject):
         }
         self.notify()
 
+    @instrumented
+    def upsert(self, environment: Environment.Environment) -> int:
+        return self.upsert_many([environment])[environment.name]
+
+    @instrumented
+    def upsert_many(self, environments: list) -> dict:
+        # name -> id, inserting the missing environments in one transaction; observers see each insert as an add
+        con = self._dbcon.get_connection()
+        with con:
+            ids, inserted = upsert_names(con, "environments", [environment.name for environment in environments])
+        by_name = {environment.name: environment for environment in environments}
+        for name in inserted:
+            self._last_action = {
+                "action": "add",
+                "object": by_name[name]
+            }
+            self.notify()
+        return ids
+
+    @instrumented
     def remove(self, object_):
         con = self._dbcon.get_connection()
         base_statement = """delete from environments where id=:id"""
@@ -654,7 +1070,7 @@ class EnvironmentDAO(DAO, Subject):
                 "op": "="
             }
         ]
-        to_delete = self.filter(delete_cond)
+        to_delete = select_for_update(con, "environments", delete_cond)
 
         with con:
             for td in to_delete:
@@ -666,9 +1082,10 @@ class EnvironmentDAO(DAO, Subject):
         }
         self.notify()
 
+    @instrumented
     def update(self, object_old: Environment.Environment, object_new: Environment.Environment):
         con = self._dbcon.get_connection()
-        base_statement = """update environments set name=:name where id=:id"""
+        base_statement = """update environments set name=:name, version=version + 1 where id=:id and version=:version"""
         update_cond = [
             {
                 "column": "name",
@@ -676,14 +1093,17 @@ class EnvironmentDAO(DAO, Subject):
                 "op": "="
             }
         ]
-        to_update = self.filter(update_cond)
+        to_update = select_for_update(con, "environments", update_cond, object_old)
 
         with con:
             for tu in to_update:
-                con.execute(base_statement, {
+                cursor = con.execute(base_statement, {
                     "id": tu[0],
-                    "name": object_new.name
+                    "name": object_new.name,
+                    "version": tu[1]
                 })
+                if not cursor.rowcount:
+                    raise ConcurrentUpdateError("environments", [tu[0]])
 
             self._last_action = {
                 "action": "update",
@@ -703,12 +1123,135 @@ class EnvironmentDAO(DAO, Subject):
             observer.update(self)
 
 
-def get_all(dao_factory: DAOFactory) -> list:
-    return dao_factory.create_DAO().get_all()
-
-
-def filter(dao_factory: DAOFactory, params: list) -> list:
-    return dao_factory.create_DAO().filter(params)
+# rows per multi-row insert or `in (...)` lookup
+UPSERT_BATCH = 500
+
+
+def where_clause(params: list) -> tuple:
+    # (" where a=:p0 and ...", {"p0": ...}) for filter params; empty when there are none
+    param_statements = [f"{param['column']}{param['op']}:p{i}" for i, param in enumerate(params)]
+    query_params = {f"p{i}": param["value"] for i, param in enumerate(params)}
+    if not param_statements:
+        return "", query_params
+    return " where " + " and ".join(param_statements), query_params
+
+
+def definite_miss(dbcon, table: str, params: list) -> bool:
+    # the connection's membership filter, if any, rules out an equality on the table's login/name
+    membership = getattr(dbcon, "membership", None)
+    return membership is not None and membership.definite_miss(table, params)
+
+
+def select_for_update(con: sqlite3.Connection, table: str, params: list, object_old=None) -> list:
+    # (id, version) of the rows an update targets; object_old.version, when set, must still match
+    expected_version = getattr(object_old, "version", None)
+    if expected_version is not None:
+        params = list(params) + [{"column": "version", "value": expected_version, "op": "="}]
+    where, query_params = where_clause(params)
+    rows = con.execute(f"select id, version from {table}{where}", query_params).fetchall()
+    if expected_version is not None and not rows:
+        raise ConcurrentUpdateError(table)
+    return rows
+
+
+def name_ids(con: sqlite3.Connection, table: str, names: list) -> dict:
+    # name -> id of the existing rows among names
+    ids = dict()
+    for start in range(0, len(names), UPSERT_BATCH):
+        chunk = names[start:start + UPSERT_BATCH]
+        placeholders = ", ".join(["?"] * len(chunk))
+        for id_, name in con.execute(f"select id, name from {table} where name in ({placeholders})", chunk):
+            ids[name] = id_
+    return ids
+
+
+def upsert_names(con: sqlite3.Connection, table: str, names: list) -> tuple:
+    # (name -> id for every name, names inserted); existing rows are left untouched
+    names = list(dict.fromkeys(names))
+    ids = dict()
+    inserted = list()
+    for start in range(0, len(names), UPSERT_BATCH):
+        chunk = names[start:start + UPSERT_BATCH]
+        values = ", ".join(["(?)"] * len(chunk))
+        statement = f"insert into {table} (name) values {values} on conflict(name) do nothing returning id, name"
+        for id_, name in con.execute(statement, chunk).fetchall():
+            ids[name] = id_
+            inserted.append(name)
+    ids.update(name_ids(con, table, [name for name in names if name not in ids]))
+    return {name: ids[name] for name in names}, inserted
+
+
+def retry_on_conflict(operation, attempts: int = 3, delay: float = .01):
+    # operation() should re-read the versions it relies on; retried with exponential backoff
+    for attempt in range(attempts):
+        try:
+            return operation()
+        except ConcurrentUpdateError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(delay * 2 ** attempt)
+
+
+# sqlite virtual machine instructions between deadline checks
+DEADLINE_CHECK_INTERVAL = 1000
+
+# connection -> expiry times of the deadlines active on it
+_deadlines = dict()
+_deadlines_lock = threading.Lock()
+
+
+def _deadline_connections(dbcon) -> list:
+    shards = getattr(dbcon, "shards", None)
+    if shards is not None:
+        return [shard.connection for shard in shards]
+    return list(dict.fromkeys((dbcon.get_connection(), dbcon.get_read_connection())))
+
+
+def _install_progress_handler(con: sqlite3.Connection):
+    expiries = _deadlines.get(con)
+    if not expiries:
+        con.set_progress_handler(None, 0)
+        return
+    expires = min(expiries)
+    con.set_progress_handler(lambda: time.monotonic() > expires, DEADLINE_CHECK_INTERVAL)
+
+
+@contextmanager
+def deadline(dbcon, timeout: float = None):
+    # statements run on dbcon's connections inside the block are aborted through sqlite's progress
+    # handler once timeout seconds have passed; nested deadlines keep the earliest, None means none
+    if timeout is None:
+        yield
+        return
+    expires = time.monotonic() + timeout
+    connections = _deadline_connections(dbcon)
+    with _deadlines_lock:
+        for con in connections:
+            _deadlines.setdefault(con, list()).append(expires)
+            _install_progress_handler(con)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if str(e) == "interrupted" and time.monotonic() > expires:
+            raise DeadlineExceededError(timeout) from e
+        raise
+    finally:
+        with _deadlines_lock:
+            for con in connections:
+                _deadlines[con].remove(expires)
+                if not _deadlines[con]:
+                    del _deadlines[con]
+                _install_progress_handler(con)
+
+
+def get_all(dao_factory: DAOFactory, timeout: float = None) -> list:
+    with deadline(dao_factory._dbcon, timeout):
+        return dao_factory.create_DAO().get_all()
+
+
+def filter(dao_factory: DAOFactory, params: list, timeout: float = None) -> list:
+    with deadline(dao_factory._dbcon, timeout):
+        return dao_factory.create_DAO().filter(params)
 
 
 def add(dao_factory: DAOFactory, objects: list) -> None:
@@ -716,6 +1259,10 @@ def add(dao_factory: DAOFactory, objects: list) -> None:
         dao_factory.create_DAO().add(object_)
 
 
+def upsert(dao_factory: DAOFactory, objects: list) -> dict:
+    return dao_factory.create_DAO().upsert_many(objects)
+
+
 def remove(dao_factory: DAOFactory, objects: list) -> None:
     for object_ in objects:
         dao_factory.create_DAO().remove(object_)
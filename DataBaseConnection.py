@@ -1,5 +1,7 @@
 import sqlite3
 import os
+import time
+from contextlib import contextmanager
 
 
 CREATE_TABLES = ["""
@@ -40,9 +42,6 @@ create table if not exists roles (
     id integer primary key autoincrement,
     name text not null
 );""",
-'''
-insert into roles (name) values ("admin"), ("user");
-''',
 """
 create table if not exists users (
     id integer primary key autoincrement,
@@ -53,11 +52,296 @@ create table if not exists users (
 );"""
 ]
 
+# idempotent; also merges roles duplicated by the old unconditional seed
+SEED_ROLES = ["""
+update users set role_id = (
+    select min(same_name.id) from roles same_name
+    where same_name.name = (select name from roles where roles.id = users.role_id)
+);""",
+"""
+delete from roles where id not in (select min(id) from roles group by name);""",
+"""
+insert into roles (name) select 'admin' where not exists (select 1 from roles where name = 'admin');""",
+"""
+insert into roles (name) select 'user' where not exists (select 1 from roles where name = 'user');"""
+]
+
+CREATE_SEARCH_INDEXES = ["""
+create virtual table if not exists resorts_fts using fts5(
+    name,
+    content='resorts',
+    content_rowid='id',
+    prefix='2 3'
+);""",
+"""
+create trigger if not exists resorts_fts_insert after insert on resorts begin
+    insert into resorts_fts (rowid, name) values (new.id, new.name);
+end;""",
+"""
+create trigger if not exists resorts_fts_delete after delete on resorts begin
+    insert into resorts_fts (resorts_fts, rowid, name) values ('delete', old.id, old.name);
+end;""",
+"""
+create trigger if not exists resorts_fts_update after update of id, name on resorts begin
+    insert into resorts_fts (resorts_fts, rowid, name) values ('delete', old.id, old.name);
+    insert into resorts_fts (rowid, name) values (new.id, new.name);
+end;""",
+"""
+create virtual table if not exists features_fts using fts5(
+    name,
+    content='features',
+    content_rowid='id',
+    prefix='2 3'
+);""",
+"""
+create trigger if not exists features_fts_insert after insert on features begin
+    insert into features_fts (rowid, name) values (new.id, new.name);
+end;""",
+"""
+create trigger if not exists features_fts_delete after delete on features begin
+    insert into features_fts (features_fts, rowid, name) values ('delete', old.id, old.name);
+end;""",
+"""
+create trigger if not exists features_fts_update after update of id, name on features begin
+    insert into features_fts (features_fts, rowid, name) values ('delete', old.id, old.name);
+    insert into features_fts (rowid, name) values (new.id, new.name);
+end;""",
+"""
+create virtual table if not exists environments_fts using fts5(
+    name,
+    content='environments',
+    content_rowid='id',
+    prefix='2 3'
+);""",
+"""
+create trigger if not exists environments_fts_insert after insert on environments begin
+    insert into environments_fts (rowid, name) values (new.id, new.name);
+end;""",
+"""
+create trigger if not exists environments_fts_delete after delete on environments begin
+    insert into environments_fts (environments_fts, rowid, name) values ('delete', old.id, old.name);
+end;""",
+"""
+create trigger if not exists environments_fts_update after update of id, name on environments begin
+    insert into environments_fts (environments_fts, rowid, name) values ('delete', old.id, old.name);
+    insert into environments_fts (rowid, name) values (new.id, new.name);
+end;""",
+"""
+insert into resorts_fts (resorts_fts) values ('rebuild');""",
+"""
+insert into features_fts (features_fts) values ('rebuild');""",
+"""
+insert into environments_fts (environments_fts) values ('rebuild');"""
+]
+
+# row versions for compare-and-swap updates
+ADD_ROW_VERSIONS = [
+    f"alter table {table} add column version integer not null default 0;"
+    for table in ("resorts", "features", "environments", "roles", "users")
+]
+
+# name list of one resort, as a JSON array sorted by name
+VIEW_NAMES = """(select json_group_array(name) from (
+    select {table}.name from resort_{table} join {table} on {table}.id = resort_{table}.{key}
+    where resort_{table}.resort_id = {resort_id} order by {table}.name))"""
+
+REBUILD_RESORT_VIEW = [
+    "delete from resort_view;",
+    f"""
+insert into resort_view (id, name, price, features, environments)
+select id, name, price,
+    {VIEW_NAMES.format(table="features", key="feature_id", resort_id="resorts.id")},
+    {VIEW_NAMES.format(table="environments", key="environment_id", resort_id="resorts.id")}
+from resorts;"""
+]
+
+# one denormalized row per resort, kept current by triggers
+CREATE_RESORT_VIEW = ["""
+create table if not exists resort_view (
+    id integer primary key,
+    name text not null,
+    price real not null,
+    features text not null default '[]',
+    environments text not null default '[]'
+);""",
+"""
+create trigger if not exists resort_view_insert after insert on resorts begin
+    insert or replace into resort_view (id, name, price) values (new.id, new.name, new.price);
+end;""",
+"""
+create trigger if not exists resort_view_update after update of id, name, price on resorts begin
+    update resort_view set id = new.id, name = new.name, price = new.price where id = old.id;
+end;""",
+"""
+create trigger if not exists resort_view_delete after delete on resorts begin
+    delete from resort_view where id = old.id;
+end;"""]
+
+for _table, _key in (("features", "feature_id"), ("environments", "environment_id")):
+    CREATE_RESORT_VIEW += [
+        f"""
+create trigger if not exists resort_view_{_table}_link_insert after insert on resort_{_table} begin
+    update resort_view set {_table} = {VIEW_NAMES.format(table=_table, key=_key, resort_id="new.resort_id")}
+    where id = new.resort_id;
+end;""",
+        f"""
+create trigger if not exists resort_view_{_table}_link_delete after delete on resort_{_table} begin
+    update resort_view set {_table} = {VIEW_NAMES.format(table=_table, key=_key, resort_id="old.resort_id")}
+    where id = old.resort_id;
+end;""",
+        f"""
+create trigger if not exists resort_view_{_table}_rename after update of name on {_table} begin
+    update resort_view set {_table} = {VIEW_NAMES.format(table=_table, key=_key, resort_id="resort_view.id")}
+    where id in (select resort_id from resort_{_table} where {_key} = new.id);
+end;""",
+        f"""
+create trigger if not exists resort_view_{_table}_delete after delete on {_table} begin
+    update resort_view set {_table} = {VIEW_NAMES.format(table=_table, key=_key, resort_id="resort_view.id")}
+    where id in (select resort_id from resort_{_table} where {_key} = old.id);
+end;"""
+    ]
+
+def check_resort_names(con: sqlite3.Connection):
+    # resorts carry a price, so same-name rows only merge when their prices agree
+    names = [name for name, in con.execute(
+        "select name from resorts group by name having count(distinct price) > 1 order by name")]
+    if names:
+        raise sqlite3.IntegrityError(f"Resorts sharing a name have different prices: {', '.join(names)}. "
+                                     "Rename or remove them before migrating.")
+
+
+# merges rows sharing a name into the lowest id, then makes names unique;
+# entries are statements or callables taking the connection
+UNIQUE_NAMES = list()
+for _table, _links in (("features", (("resort_features", "feature_id", "resort_id"),)),
+                       ("environments", (("resort_environments", "environment_id", "resort_id"),)),
+                       ("resorts", (("resort_features", "resort_id", "feature_id"),
+                                    ("resort_environments", "resort_id", "environment_id")))):
+    if _table == "resorts":
+        UNIQUE_NAMES.append(check_resort_names)
+    for _link, _key, _other in _links:
+        UNIQUE_NAMES += [
+            f"""
+insert into {_link} ({_key}, {_other}) select keeper.id, {_link}.{_other}
+from {_link} join {_table} on {_table}.id = {_link}.{_key}
+join (select min(id) as id, name from {_table} group by name) keeper on keeper.name = {_table}.name
+where keeper.id != {_table}.id
+on conflict do nothing;""",
+            f"""
+delete from {_link} where {_key} not in (select min(id) from {_table} group by name);"""
+        ]
+    UNIQUE_NAMES += [
+        f"""
+delete from {_table} where id not in (select min(id) from {_table} group by name);""",
+        f"""
+create unique index if not exists {_table}_name on {_table} (name);"""
+    ]
+UNIQUE_NAMES += SEED_ROLES[:2] + ["""
+create unique index if not exists roles_name on roles (name);"""]
+
+# MIGRATIONS[i] brings the schema from version i to i + 1 (pragma user_version)
+MIGRATIONS = [
+    CREATE_TABLES + SEED_ROLES,
+    CREATE_SEARCH_INDEXES,
+    ADD_ROW_VERSIONS,
+    CREATE_RESORT_VIEW + REBUILD_RESORT_VIEW,
+    UNIQUE_NAMES
+]
+
+
+PROFILES = {
+    "durable": {
+        "journal_mode": "wal",
+        "synchronous": "full",
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "temp_store": "default",
+        "foreign_keys": "on",
+        "query_only": "off"
+    },
+    "balanced": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "memory",
+        "foreign_keys": "on",
+        "query_only": "off"
+    },
+    # no crash safety: only for imports that can be re-run from scratch
+    "bulk-load": {
+        "journal_mode": "memory",
+        "synchronous": "off",
+        "cache_size": -262144,
+        "mmap_size": 268435456,
+        "temp_store": "memory",
+        "foreign_keys": "on",
+        "query_only": "off"
+    },
+    "read-only": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64000,
+        "mmap_size": 1073741824,
+        "temp_store": "memory",
+        "foreign_keys": "on",
+        "query_only": "on"
+    }
+}
+
+
+def apply_profile(con: sqlite3.Connection, profile: str):
+    try:
+        pragmas = PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"Unknown profile: {profile}.")
+
+    if con.in_transaction:
+        raise sqlite3.OperationalError("Cannot switch profile inside a transaction.")
+    for pragma, value in pragmas.items():
+        con.execute(f"pragma {pragma}={value}")
+
+
+def schema_version(con: sqlite3.Connection) -> int:
+    return con.execute("pragma user_version").fetchone()[0]
+
+
+def migrate(con: sqlite3.Connection):
+    # a current schema costs one pragma read; otherwise pending migrations run one transaction each
+    if schema_version(con) == len(MIGRATIONS):
+        return
+
+    while True:
+        con.execute("begin immediate")
+        try:
+            # re-read under the write lock, another process may have migrated meanwhile
+            version = schema_version(con)
+            if version > len(MIGRATIONS):
+                raise sqlite3.DatabaseError(f"Schema version {version} is newer than this code.")
+            if version == len(MIGRATIONS):
+                con.rollback()
+                return
+            for statement in MIGRATIONS[version]:
+                if callable(statement):
+                    statement(con)
+                else:
+                    con.execute(statement)
+            con.execute(f"pragma user_version={version + 1}")
+        except Exception:
+            con.rollback()
+            raise
+        con.commit()
+
 
 class DataBaseConnection(object):
     __instance = None
     connection = None
     db_file_path: str = None
+    membership = None
+    metrics = None
+    profile: str = None
+    replica = None
+    sharded: bool = False
 
     def __init__(self):
         pass
@@ -69,7 +353,32 @@ class DataBaseConnection(object):
         return cls.__instance.connection
 
     @classmethod
-    def open_connection(cls, db_file_path: str, reinit_file: bool = False):
+    def get_read_connection(cls):
+        # reads go to the attached Replica.ReadReplica, if any
+        if cls.replica:
+            return cls.replica.get_connection(cls.__instance.connection)
+        return cls.get_connection()
+
+    @classmethod
+    def attach_replica(cls, replica):
+        cls.replica = replica
+
+    @classmethod
+    def detach_replica(cls):
+        cls.replica = None
+
+    @classmethod
+    def attach_membership(cls, membership):
+        # membership: MembershipFilter.MembershipFilter, loaded and subscribed; filters on a login or
+        # name it rules out return without SQL
+        cls.membership = membership
+
+    @classmethod
+    def detach_membership(cls):
+        cls.membership = None
+
+    @classmethod
+    def open_connection(cls, db_file_path: str, reinit_file: bool = False, profile: str = "durable"):
         if cls.__instance.connection:
             # close previous connection
             raise ConnectionError("Close previous connection.")
@@ -77,11 +386,35 @@ class DataBaseConnection(object):
         # open new connection
         cls.db_file_path = db_file_path
         if reinit_file:
-            if os.path.exists(db_file_path):
-                os.remove(db_file_path)
+            for path in (db_file_path, db_file_path + "-wal", db_file_path + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
 
-        cls.__instance.connection = sqlite3.connect(db_file_path)
-        return cls.__instance.connection
+        return cls._install(sqlite3.connect(db_file_path), profile)
+
+    @classmethod
+    def _install(cls, connection: sqlite3.Connection, profile: str):
+        cls.__instance.connection = connection
+        if cls.metrics:
+            connection.set_trace_callback(cls.metrics.trace)
+        cls.set_profile(profile)
+        return connection
+
+    @classmethod
+    def set_profile(cls, profile: str):
+        apply_profile(cls.get_connection(), profile)
+        cls.profile = profile
+
+    @classmethod
+    @contextmanager
+    def use_profile(cls, profile: str):
+        # e.g. `with DataBaseConnection.use_profile("bulk-load"):` around an import
+        previous = cls.profile
+        cls.set_profile(profile)
+        try:
+            yield cls.get_connection()
+        finally:
+            cls.set_profile(previous)
 
     @classmethod
     def close_connection(cls):
@@ -93,6 +426,23 @@ class DataBaseConnection(object):
             finally:
                 cls.__instance.connection = None
 
+    @classmethod
+    def enable_metrics(cls, metrics=None):
+        # metrics: Metrics.QueryMetrics; DAO calls are recorded while it is set
+        if metrics is None:
+            from Metrics import QueryMetrics
+            metrics = QueryMetrics()
+        cls.metrics = metrics
+        if cls.__instance and cls.__instance.connection:
+            cls.__instance.connection.set_trace_callback(metrics.trace)
+        return metrics
+
+    @classmethod
+    def disable_metrics(cls):
+        cls.metrics = None
+        if cls.__instance and cls.__instance.connection:
+            cls.__instance.connection.set_trace_callback(None)
+
     @classmethod
     def get_instance(cls):
         if not cls.__instance:
@@ -100,11 +450,89 @@ class DataBaseConnection(object):
         return cls.__instance
 
     @classmethod
-    def init_tables(cls):
+    def backup(cls, target_path: str, pages: int = 256, progress=None, sleep: float = 0.25):
+        # online backup: copies `pages` pages per step and pauses `sleep` seconds after each step but
+        # the last, with the source unlocked, so writers get in; a write from another connection
+        # restarts the copy. progress(status, remaining, total) is called after every step
+        def step(status, remaining, total):
+            if progress:
+                progress(status, remaining, total)
+            if remaining and sleep > 0:
+                time.sleep(sleep)
+
         con = cls.get_connection()
-        with con:
-            for statement in CREATE_TABLES:
-                con.execute(statement)
+        target = sqlite3.connect(target_path)
+        try:
+            con.backup(target, pages=pages, progress=step)
+        finally:
+            target.close()
+
+    @classmethod
+    def restore(cls, source_path: str, db_file_path: str = ":memory:", pages: int = -1, progress=None,
+                profile: str = "durable"):
+        # replaces the current connection with a fresh database filled from a backup
+        if not os.path.exists(source_path):
+            raise FileNotFoundError(source_path)
+
+        cls.close_connection()
+        cls.db_file_path = db_file_path
+        for path in (db_file_path, db_file_path + "-wal", db_file_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+        # the profile comes after the copy: in WAL mode the destination could not take the source's page size
+        con = sqlite3.connect(db_file_path)
+        source = sqlite3.connect(source_path)
+        try:
+            source.backup(con, pages=pages, progress=progress)
+        except BaseException:
+            con.close()
+            raise
+        finally:
+            source.close()
+        return cls._install(con, profile)
+
+    @classmethod
+    def clone_template(cls, template_path: str, db_file_path: str = ":memory:", profile: str = "durable"):
+        # start from a prebuilt (initialized and seeded) database instead of init_tables;
+        # copied through the backup API, which also picks up pages still in the template's -wal file
+        return cls.restore(template_path, db_file_path, profile=profile)
+
+    @classmethod
+    def schema_version(cls) -> int:
+        return schema_version(cls.get_connection())
+
+    @classmethod
+    def init_tables(cls):
+        migrate(cls.get_connection())
+
+
+class ConnectionHolder(object):
+    # DataBaseConnection interface over one independently opened connection,
+    # for DAOs used in worker threads and processes
+    membership = None
+    metrics = None
+    sharded: bool = False
+
+    def __init__(self, connection: sqlite3.Connection = None):
+        self.connection = connection
+
+    def get_connection(self):
+        if not self.connection:
+            raise ValueError("No connection.")
+        return self.connection
+
+    def get_read_connection(self):
+        return self.get_connection()
+
+    def close_connection(self):
+        if self.connection:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            finally:
+                self.connection = None
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 class Environment:
-    def __init__(self, name: str = ""):
+    def __init__(self, name: str = "", version: int = None):
         self.name = name
+        self.version = version
 
 
 class EnvironmentBuilder:
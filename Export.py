@@ -0,0 +1,93 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+
+from DataBaseConnection import DataBaseConnection
+from DAOFactoryMethod import ResortDAOFactory
+
+
+class ResortExporter:
+
+    _formats = ("jsonl", "csv")
+    _csv_header = ("id", "name", "price", "features", "environments")
+
+    def __init__(self, dbcon: DataBaseConnection = None, fmt: str = "jsonl", shard_size: int = None):
+        if fmt not in self._formats:
+            raise ValueError(f"Unknown format: {fmt}.")
+        if shard_size is not None and shard_size <= 0:
+            raise ValueError("Shard size must be positive.")
+        self._dbcon = dbcon
+        self._fmt = fmt
+        self._shard_size = shard_size
+
+    def _shard_path(self, path_prefix: str, shard: int) -> str:
+        if self._shard_size is None:
+            return f"{path_prefix}.{self._fmt}.gz"
+        return f"{path_prefix}-{shard:05d}.{self._fmt}.gz"
+
+    def _open_shard(self, path: str):
+        text = io.TextIOWrapper(gzip.open(path, "wb"), encoding="utf-8", newline="")
+        writer = None
+        if self._fmt == "csv":
+            writer = csv.writer(text)
+            writer.writerow(self._csv_header)
+        return text, writer
+
+    def _write_row(self, text, writer, row: tuple):
+        id_, name, price, features, environments = row
+        if self._fmt == "csv":
+            writer.writerow((id_, name, price, "|".join(features), "|".join(environments)))
+        else:
+            text.write(json.dumps({
+                "id": id_,
+                "name": name,
+                "price": price,
+                "features": features,
+                "environments": environments
+            }))
+            text.write("\n")
+
+    def export(self, path_prefix: str) -> list:
+        # rows are streamed from one cursor, so memory does not grow with the table
+        resortDAO = ResortDAOFactory(self._dbcon).create_DAO()
+        written = list()
+        text, writer = None, None
+        rows_in_shard = 0
+        try:
+            for row in resortDAO.iterate_with_names():
+                if text is None or (self._shard_size and rows_in_shard == self._shard_size):
+                    if text is not None:
+                        text.close()
+                    written.append(self._shard_path(path_prefix, len(written)))
+                    text, writer = self._open_shard(written[-1])
+                    rows_in_shard = 0
+                self._write_row(text, writer, row)
+                rows_in_shard += 1
+            if text is None:
+                # empty catalogue still produces one (empty) file
+                written.append(self._shard_path(path_prefix, 0))
+                text, writer = self._open_shard(written[-1])
+        finally:
+            if text is not None:
+                text.close()
+        return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export resorts with feature and environment names.")
+    parser.add_argument("db_file_path")
+    parser.add_argument("path_prefix")
+    parser.add_argument("--format", choices=ResortExporter._formats, default="jsonl")
+    parser.add_argument("--shard-size", type=int, default=None)
+    args = parser.parse_args()
+
+    dbcon = DataBaseConnection.get_instance()
+    dbcon.open_connection(args.db_file_path)
+    try:
+        exporter = ResortExporter(dbcon, args.format, args.shard_size)
+        for path in exporter.export(args.path_prefix):
+            print(path)
+    finally:
+        dbcon.close_connection()
@@ -0,0 +1,147 @@
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from DataBaseConnection import ConnectionHolder, apply_profile
+
+
+class BatchConnection(sqlite3.Connection):
+    # while batching, `with con:` blocks inside DAO methods neither commit nor roll back;
+    # the writer owns the transaction
+
+    batching: bool = False
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.batching:
+            return False
+        return super().__exit__(exc_type, exc_val, exc_tb)
+
+
+class GroupCommitWriter:
+    _stop = object()
+
+    def __init__(self, db_file_path: str, batch_size: int = 256, window: float = .005, profile: str = "durable"):
+        self._db_file_path = db_file_path
+        self._batch_size = batch_size
+        self._window = window
+        self._profile = profile
+        self._queue = queue.Queue()
+        self._thread = None
+        self.batches = 0
+        self.writes = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if self._thread:
+            raise RuntimeError("Writer already started.")
+        started = Future()
+        self._thread = threading.Thread(target=self._run, args=(started,), name="group-commit-writer", daemon=True)
+        self._thread.start()
+        started.result()
+
+    def close(self):
+        if self._thread:
+            self._queue.put(self._stop)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, dao_class, method: str, *args) -> Future:
+        # e.g. submit(ResortDAO, "update", old, new); resolved after the batch commits
+        if not self._thread:
+            raise RuntimeError("Writer not started.")
+        future = Future()
+        self._queue.put((future, dao_class, method, args))
+        return future
+
+    def add(self, dao_class, object_) -> Future:
+        return self.submit(dao_class, "add", object_)
+
+    def remove(self, dao_class, object_) -> Future:
+        return self.submit(dao_class, "remove", object_)
+
+    def update(self, dao_class, object_old, object_new) -> Future:
+        return self.submit(dao_class, "update", object_old, object_new)
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self._window
+        while batch[-1] is not self._stop and len(batch) < self._batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, started: Future):
+        try:
+            con = sqlite3.connect(self._db_file_path, factory=BatchConnection)
+            apply_profile(con, self._profile)
+        except Exception as e:
+            started.set_exception(e)
+            return
+        started.set_result(True)
+
+        dbcon = ConnectionHolder(con)
+        try:
+            while True:
+                batch = self._next_batch()
+                stop = batch[-1] is self._stop
+                if stop:
+                    batch.pop()
+                if batch:
+                    self._commit(dbcon, batch)
+                if stop:
+                    break
+        finally:
+            dbcon.close_connection()
+
+    def _commit(self, dbcon: ConnectionHolder, batch: list):
+        con = dbcon.get_connection()
+        done = list()
+        con.batching = True
+        try:
+            con.execute("begin immediate")
+            for future, dao_class, method, args in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                dao = dao_class(dbcon)
+                if hasattr(dao, "notify"):
+                    # silenced until commit
+                    dao._observers = list()
+                con.execute("savepoint write")
+                try:
+                    result = getattr(dao, method)(*args)
+                except Exception as e:
+                    con.execute("rollback to write")
+                    con.execute("release write")
+                    future.set_exception(e)
+                else:
+                    con.execute("release write")
+                    done.append((future, dao, result))
+            con.commit()
+        except Exception as e:
+            if con.in_transaction:
+                con.rollback()
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            con.batching = False
+
+        self.batches += 1
+        self.writes += len(done)
+        for future, dao, result in done:
+            if hasattr(dao, "notify"):
+                del dao._observers
+                dao.notify()
+            future.set_result(result)
@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import Environment
+import Feature
+import Resort
+import User
+from SubjectObserver import Observer, Subject
+from DataBaseConnection import ConnectionHolder, apply_profile, migrate
+from DAOFactoryMethod import DAOProxy, ResortDAO, FeatureDAO, EnvironmentDAO, UserDAOFactory, ConcurrentUpdateError, \
+    DeadlineExceededError, add
+from Scheduler import AdmissionError, RoleScheduler
+
+
+FEATURES = ["spa", "golf", "water_park", "kids_club", "casino", "diving"]
+ENVIRONMENTS = ["savannah", "ocean", "mountain", "lake", "desert"]
+LOGIN = "loadgen"
+PASSWORD = "loadgen"
+
+error_log = logging.getLogger("dao.loadgen")
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return .0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Window:
+    # raw samples of one reporting interval
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"read": list(), "write": list()}
+        self.errors = {"locked": 0, "conflict": 0, "deadline": 0, "admission": 0, "other": 0}
+        self.dispatch = list()
+
+    def record(self, kind: str, latency: float):
+        with self.lock:
+            self.latencies[kind].append(latency)
+
+    def error(self, kind: str):
+        with self.lock:
+            self.errors[kind] += 1
+
+    def report(self, elapsed: float) -> dict:
+        with self.lock:
+            report = {"ops_per_s": sum(len(samples) for samples in self.latencies.values()) / elapsed}
+            for kind, samples in self.latencies.items():
+                ordered = sorted(samples)
+                report[kind] = {
+                    "count": len(ordered),
+                    "p50": percentile(ordered, .50),
+                    "p95": percentile(ordered, .95),
+                    "p99": percentile(ordered, .99),
+                    "max": ordered[-1] if ordered else .0
+                }
+            report["errors"] = dict(self.errors)
+            report["dispatch"] = {
+                "count": len(self.dispatch),
+                "mean": sum(self.dispatch) / len(self.dispatch) if self.dispatch else .0,
+                "max": max(self.dispatch, default=.0)
+            }
+        return report
+
+
+class DispatchProbe(Observer):
+    # attached first and last to ResortDAO's observers; the gap is the cost of the observers between
+
+    def __init__(self, generator, first: bool):
+        self._generator = generator
+        self._first = first
+
+    def update(self, subject: Subject) -> None:
+        local = self._generator.local
+        if self._first:
+            local.dispatch_start = time.perf_counter()
+        elif getattr(local, "dispatch_start", None) is not None:
+            window = self._generator.window
+            with window.lock:
+                window.dispatch.append(time.perf_counter() - local.dispatch_start)
+            local.dispatch_start = None
+
+
+class LoadGenerator:
+
+    def __init__(self, db_file_path: str, read_ratio: float = .9, concurrency: int = 8, rate: float = None,
+                 resorts: int = 1000, duration: float = 10.0, mode: str = "threads", interval: float = 1.0,
+                 profile: str = "balanced", busy_timeout: float = 1.0, scheduler: RoleScheduler = None):
+        # scheduler: shared by every session's proxies; its rejections are counted as "admission" errors
+        if mode not in ("threads", "asyncio"):
+            raise ValueError(f"Unknown mode: {mode}.")
+        self._db_file_path = db_file_path
+        self._read_ratio = read_ratio
+        self._concurrency = concurrency
+        self._rate = rate
+        self._resorts = resorts
+        self._duration = duration
+        self._mode = mode
+        self._interval = interval
+        self._profile = profile
+        self._busy_timeout = busy_timeout
+        self._scheduler = scheduler
+        self._slot_lock = threading.Lock()
+        self._next_slot = .0
+        self._deadline = .0
+        self._added = 0
+        self._logged = set()
+        self.local = threading.local()
+        self.window = Window()
+        self.reports = list()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self._db_file_path, timeout=self._busy_timeout)
+        apply_profile(con, self._profile)
+        return con
+
+    def prepare(self):
+        # schema, reference data, `resorts` rows and an admin login for the proxies
+        dbcon = ConnectionHolder(self._connect())
+        try:
+            con = dbcon.get_connection()
+            migrate(con)
+            FeatureDAO(dbcon).upsert_many([Feature.Feature(name) for name in FEATURES])
+            EnvironmentDAO(dbcon).upsert_many([Environment.Environment(name) for name in ENVIRONMENTS])
+            with con:
+                existing = con.execute("select count(*) from resorts").fetchone()[0]
+                con.executemany("insert into resorts (name, price) values (?, ?) on conflict(name) do nothing",
+                                ((f"load_{i}", random.uniform(500.0, 50000.0)) for i in range(self._resorts)))
+            if not con.execute("select 1 from users where login = ?", (LOGIN,)).fetchone():
+                add(UserDAOFactory(dbcon), [User.User(LOGIN, PASSWORD, "admin")])
+            self._resorts = max(self._resorts, existing)
+        finally:
+            dbcon.close_connection()
+
+    def _session(self) -> dict:
+        # one connection and one logged-in proxy per DAO, per worker thread
+        session = getattr(self.local, "session", None)
+        if session is None:
+            dbcon = ConnectionHolder(self._connect())
+            session = dict()
+            for name, dao_class in (("resorts", ResortDAO), ("features", FeatureDAO), ("environments", EnvironmentDAO)):
+                proxy = DAOProxy(dao_class(dbcon), scheduler=self._scheduler)
+                if not proxy.login(LOGIN, PASSWORD):
+                    raise PermissionError("Load generator login failed.")
+                session[name] = proxy
+            session["dbcon"] = dbcon
+            self.local.session = session
+        return session
+
+    def _close_session(self):
+        session = getattr(self.local, "session", None)
+        if session:
+            session["dbcon"].close_connection()
+            self.local.session = None
+
+    def _take_slot(self) -> float:
+        # open-loop pacing: returns how long to wait for this request's slot
+        if not self._rate:
+            return .0
+        with self._slot_lock:
+            now = time.perf_counter()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + 1.0 / self._rate
+        return slot - now
+
+    def _read(self, session: dict):
+        choice = random.random()
+        if choice < .6:
+            low = random.uniform(500.0, 45000.0)
+            session["resorts"].filter([
+                {"column": "price", "value": low, "op": ">="},
+                {"column": "price", "value": low + 1000.0, "op": "<"}
+            ])
+        elif choice < .8:
+            session["features"].get_all()
+        else:
+            session["environments"].get_all()
+
+    def _write(self, session: dict):
+        resorts = session["resorts"]
+        if random.random() < .7:
+            name = f"load_{random.randrange(self._resorts)}"
+            rows = resorts.filter([{"column": "name", "value": name, "op": "="}])
+            if rows:
+                (_, version), = resorts.versions([{"column": "id", "value": rows[0][0], "op": "="}])
+                resorts.update(Resort.Resort(name, rows[0][2], version=version),
+                               Resort.Resort(name, random.uniform(500.0, 50000.0)))
+        else:
+            with self._slot_lock:
+                self._added += 1
+                number = self._added
+            resorts.add(Resort.Resort(f"load_new_{threading.get_ident()}_{number}", random.uniform(500.0, 50000.0),
+                                      set(random.sample(FEATURES, 2)), {random.choice(ENVIRONMENTS)}))
+
+    def _one_request(self):
+        session = self._session()
+        kind = "read" if random.random() < self._read_ratio else "write"
+        start = time.perf_counter()
+        try:
+            if kind == "read":
+                self._read(session)
+            else:
+                self._write(session)
+        except ConcurrentUpdateError:
+            self.window.error("conflict")
+        except DeadlineExceededError:
+            self.window.error("deadline")
+        except AdmissionError:
+            self.window.error("admission")
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                self.window.error("locked")
+            else:
+                self._other_error(e)
+        except Exception as e:
+            self._other_error(e)
+        else:
+            self.window.record(kind, time.perf_counter() - start)
+
+    def _other_error(self, error: Exception):
+        # counted as "other"; the first traceback of each exception type is logged
+        self.window.error("other")
+        with self._slot_lock:
+            first = type(error) not in self._logged
+            self._logged.add(type(error))
+        if first:
+            error_log.error("Load request failed", exc_info=error)
+
+    def _thread_worker(self):
+        try:
+            while time.perf_counter() < self._deadline:
+                wait = self._take_slot()
+                if wait > 0:
+                    time.sleep(wait)
+                self._one_request()
+        finally:
+            self._close_session()
+
+    async def _async_main(self):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(self._concurrency)
+
+        async def task():
+            while time.perf_counter() < self._deadline:
+                wait = self._take_slot()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await loop.run_in_executor(executor, self._one_request)
+
+        try:
+            await asyncio.gather(*(task() for _ in range(self._concurrency)))
+        finally:
+            # connections belong to the threads that opened them: one close per worker thread, each
+            # held at the barrier until all have started, so no thread can take two
+            barrier = threading.Barrier(self._concurrency)
+
+            def close():
+                try:
+                    self._close_session()
+                finally:
+                    barrier.wait()
+
+            for _ in range(self._concurrency):
+                executor.submit(close)
+            executor.shutdown()
+
+    def _reporter(self, stop: threading.Event):
+        start = time.perf_counter()
+        last = start
+        while not stop.wait(self._interval):
+            now = time.perf_counter()
+            self._report(now - start, now - last)
+            last = now
+        now = time.perf_counter()
+        if now - last > self._interval / 10:
+            self._report(now - start, now - last)
+
+    def _report(self, at: float, elapsed: float):
+        window, self.window = self.window, Window()
+        report = window.report(elapsed)
+        report["t"] = at
+        self.reports.append(report)
+        read, write, dispatch = report["read"], report["write"], report["dispatch"]
+        print(f"t={at:6.1f}s {report['ops_per_s']:8.0f} ops/s | "
+              f"read p50/p95/p99/max {read['p50'] * 1000:.2f}/{read['p95'] * 1000:.2f}/"
+              f"{read['p99'] * 1000:.2f}/{read['max'] * 1000:.2f} ms | "
+              f"write {write['p50'] * 1000:.2f}/{write['p95'] * 1000:.2f}/"
+              f"{write['p99'] * 1000:.2f}/{write['max'] * 1000:.2f} ms | "
+              f"locked {report['errors']['locked']} conflict {report['errors']['conflict']} "
+              f"deadline {report['errors']['deadline']} admission {report['errors']['admission']} "
+              f"other {report['errors']['other']} | dispatch {dispatch['mean'] * 1e6:.1f} us")
+
+    def run(self) -> list:
+        first, last = DispatchProbe(self, True), DispatchProbe(self, False)
+        ResortDAO._observers.insert(0, first)
+        ResortDAO._observers.append(last)
+        stop = threading.Event()
+        reporter = threading.Thread(target=self._reporter, args=(stop,), daemon=True)
+        self._next_slot = time.perf_counter()
+        self._deadline = time.perf_counter() + self._duration
+        reporter.start()
+        try:
+            if self._mode == "asyncio":
+                asyncio.run(self._async_main())
+            else:
+                workers = [threading.Thread(target=self._thread_worker) for _ in range(self._concurrency)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        finally:
+            stop.set()
+            reporter.join()
+            ResortDAO._observers.remove(first)
+            ResortDAO._observers.remove(last)
+        return self.reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mixed read/write load against the DAO layer through DAOProxy.")
+    parser.add_argument("db_file_path")
+    parser.add_argument("--read-ratio", type=float, default=.9)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=None, help="target requests per second (default: unpaced)")
+    parser.add_argument("--resorts", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--mode", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--profile", default="balanced")
+    parser.add_argument("--scheduler", type=int, default=None, metavar="SLOTS",
+                        help="order DAO calls through a RoleScheduler with this many slots (default: none)")
+    parser.add_argument("--max-queue", type=int, default=256, help="scheduler queue limit per role")
+    args = parser.parse_args()
+
+    scheduler = None
+    if args.scheduler:
+        scheduler = RoleScheduler(concurrency=args.scheduler, max_queue={"user": args.max_queue, "admin": args.max_queue})
+    generator = LoadGenerator(args.db_file_path, args.read_ratio, args.concurrency, args.rate, args.resorts,
+                              args.duration, args.mode, args.interval, args.profile, scheduler=scheduler)
+    generator.prepare()
+    generator.run()
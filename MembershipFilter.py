@@ -0,0 +1,130 @@
+import hashlib
+import math
+
+from SubjectObserver import Observer, Subject
+from DataBaseConnection import DataBaseConnection
+from DAOFactoryMethod import UserDAO, ResortDAO, FeatureDAO, EnvironmentDAO
+
+
+# table -> the column whose values are tracked
+KEYS = {
+    "users": "login",
+    "resorts": "name",
+    "features": "name",
+    "environments": "name"
+}
+
+
+class BloomFilter:
+    # fixed-size bit array with k positions per key from double hashing of one blake2b digest
+
+    def __init__(self, capacity: int, error_rate: float = .01):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.bits = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._array[position >> 3] & 1 << (position & 7) for position in self._positions(key))
+
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def estimated_error_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def memory_bytes(self) -> int:
+        return len(self._array)
+
+
+class MembershipFilter(Observer):
+    # per-table Bloom filters over logins and names: a miss means the value is certainly absent,
+    # so equality filters on it return without running SQL. Built by load(), kept current as a
+    # DAO observer; values only ever get added, so renames and removals leave harmless false
+    # positives. Rows written around the DAOs (raw SQL, other processes) need a new load().
+    # A full filter gets a twice larger one next to it with half the error rate, so the total
+    # stays under error_rate
+
+    def __init__(self, dbcon: DataBaseConnection = None, error_rate: float = .01, min_capacity: int = 1024,
+                 headroom: float = 2.0):
+        self._dbcon = dbcon
+        self._error_rate = error_rate
+        self._min_capacity = min_capacity
+        self._headroom = headroom
+        self._filters = {table: [BloomFilter(min_capacity, error_rate / 2)] for table in KEYS}
+
+    def load(self):
+        con = self._dbcon.get_read_connection()
+        filters = dict()
+        with con:
+            for table, column in KEYS.items():
+                values = [value for value, in con.execute(f"select {column} from {table}")]
+                bloom = BloomFilter(max(self._min_capacity, int(len(values) * self._headroom)), self._error_rate / 2)
+                for value in values:
+                    bloom.add(value)
+                filters[table] = [bloom]
+        self._filters = filters
+
+    def subscribe(self):
+        for dao_class in (UserDAO, ResortDAO, FeatureDAO, EnvironmentDAO):
+            dao = dao_class(self._dbcon)
+            if self not in dao._observers:
+                dao.attach(self)
+
+    def unsubscribe(self):
+        for dao_class in (UserDAO, ResortDAO, FeatureDAO, EnvironmentDAO):
+            dao = dao_class(self._dbcon)
+            if self in dao._observers:
+                dao.detach(self)
+
+    def add(self, table: str, value: str):
+        filters = self._filters[table]
+        if filters[-1].full():
+            filters.append(BloomFilter(filters[-1].capacity * 2, filters[-1].error_rate / 2))
+        filters[-1].add(value)
+
+    def might_contain(self, table: str, value) -> bool:
+        value = str(value)
+        return any(value in bloom for bloom in self._filters[table])
+
+    def definite_miss(self, table: str, params: list) -> bool:
+        # params are and-ed: one equality on the key column that misses empties the result
+        column = KEYS.get(table)
+        return any(param["column"] == column and param["op"] == "=" and not self.might_contain(table, param["value"])
+                   for param in params)
+
+    def update(self, subject: Subject) -> None:
+        action = subject._last_action
+        table = subject._table
+        if action["action"] == "add":
+            self.add(table, getattr(action["object"], KEYS[table]))
+        elif action["action"] == "update":
+            self.add(table, getattr(action["new"], KEYS[table]))
+
+    def memory_bytes(self) -> int:
+        return sum(bloom.memory_bytes() for filters in self._filters.values() for bloom in filters)
+
+    def report(self) -> dict:
+        # per table: values added, capacity, bytes and the estimated false-positive rate
+        report = dict()
+        for table, filters in self._filters.items():
+            report[table] = {
+                "count": sum(bloom.count for bloom in filters),
+                "capacity": sum(bloom.capacity for bloom in filters),
+                "bytes": sum(bloom.memory_bytes() for bloom in filters),
+                "error_rate": 1 - math.prod(1 - bloom.estimated_error_rate() for bloom in filters)
+            }
+        return report
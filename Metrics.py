@@ -0,0 +1,359 @@
+import logging
+import re
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from functools import wraps
+
+
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+# bytes, 1 KiB to 4 GiB
+MEMORY_BUCKETS = tuple(float(2 ** power) for power in range(10, 33, 2))
+
+slow_query_log = logging.getLogger("dao.slow_query")
+memory_log = logging.getLogger("dao.memory")
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = .0
+        self.max = .0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-th sample, capped by the observed max
+        if not self.count:
+            return .0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(.50),
+            "p95": self.percentile(.95),
+            "p99": self.percentile(.99)
+        }
+
+
+def prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def histogram_lines(metric: str, labels: str, histogram: Histogram) -> list:
+    # Prometheus text lines of one histogram; labels like 'method="x"' or ""
+    lines = list()
+    separator = "," if labels else ""
+    selector = f"{{{labels}}}" if labels else ""
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{metric}_bucket{{{labels}{separator}le=\"{bound}\"}} {cumulative}")
+    lines.append(f"{metric}_bucket{{{labels}{separator}le=\"+Inf\"}} {histogram.count}")
+    lines.append(f"{metric}_sum{selector} {histogram.sum}")
+    lines.append(f"{metric}_count{selector} {histogram.count}")
+    return lines
+
+
+def statement_shape(statement: str) -> str:
+    shape = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    shape = re.sub(r"\b\d+(?:\.\d+)?\b", "?", shape)
+    shape = re.sub(r":\w+", "?", shape)
+    return " ".join(shape.split()).rstrip(";").lower()
+
+
+class QueryMetrics:
+
+    def __init__(self, slow_threshold: float = .1):
+        self.slow_threshold = slow_threshold
+        self.slow_queries = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._calls = dict()
+        self._rows = dict()
+        self._statements = dict()
+        self._transactions = Histogram()
+
+    def reset(self):
+        with self._lock:
+            self.slow_queries = 0
+            self._calls = dict()
+            self._rows = dict()
+            self._statements = dict()
+            self._transactions = Histogram()
+
+    def _observe_statement(self, shape: str, duration: float):
+        with self._lock:
+            if shape not in self._statements:
+                self._statements[shape] = Histogram()
+            self._statements[shape].observe(duration)
+
+    def _close_statement(self, now: float):
+        # a statement's time runs until the next traced statement or the end of the call,
+        # so it includes fetching its rows into Python
+        current = getattr(self._local, "statement", None)
+        if current is not None:
+            self._local.statement = None
+            self._observe_statement(current[0], now - current[1])
+
+    def trace(self, statement: str):
+        # sqlite3 trace callback, installed by DataBaseConnection.enable_metrics
+        local = self._local
+        if statement.startswith("--") or (getattr(local, "statement", None) and statement == local.raw):
+            # FTS sub-programs, and the parent's text repeated as each of its triggers starts;
+            # their time belongs to the statement that fired them
+            return
+        now = time.perf_counter()
+        shape = statement_shape(statement)
+
+        if shape.startswith("begin"):
+            local.transaction_start = now
+        elif shape.startswith(("commit", "rollback")):
+            start = getattr(local, "transaction_start", None)
+            if start is not None:
+                local.transaction_start = None
+                with self._lock:
+                    self._transactions.observe(now - start)
+
+        # statements outside DAO calls (pragmas, migrations, generators) have no timing to record
+        if getattr(local, "depth", 0):
+            self._close_statement(now)
+            local.statement = (shape, now)
+            local.raw = statement
+            local.traced.append(shape)
+
+    def measure(self, name: str, method, *args, **kwargs):
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        if not depth:
+            local.traced = list()
+        local.depth = depth + 1
+        result = None
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+            return result
+        finally:
+            now = time.perf_counter()
+            local.depth = depth
+            if not depth:
+                self._close_statement(now)
+            self.record_call(name, now - start, result)
+
+    def record_call(self, name: str, duration: float, result=None):
+        rows = len(result) if isinstance(result, list) else 0
+        with self._lock:
+            if name not in self._calls:
+                self._calls[name] = Histogram()
+                self._rows[name] = 0
+            self._calls[name].observe(duration)
+            self._rows[name] += rows
+            slow = duration >= self.slow_threshold
+            if slow:
+                self.slow_queries += 1
+
+        if slow:
+            statements = "; ".join(getattr(self._local, "traced", ()))
+            slow_query_log.warning("%s took %.3fs (%d rows): %s", name, duration, rows, statements)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "methods": {
+                    name: dict(histogram.snapshot(), rows=self._rows[name])
+                    for name, histogram in self._calls.items()
+                },
+                "statements": {shape: histogram.snapshot() for shape, histogram in self._statements.items()},
+                "transactions": self._transactions.snapshot(),
+                "slow_queries": self.slow_queries
+            }
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            lines = ["# TYPE dao_call_duration_seconds histogram"]
+            for name, histogram in self._calls.items():
+                lines += histogram_lines("dao_call_duration_seconds", f"method=\"{prometheus_label(name)}\"", histogram)
+
+            lines.append("# TYPE dao_call_rows_total counter")
+            for name, rows in self._rows.items():
+                lines.append(f"dao_call_rows_total{{method=\"{prometheus_label(name)}\"}} {rows}")
+
+            lines.append("# TYPE dao_statement_duration_seconds histogram")
+            for shape, histogram in self._statements.items():
+                lines += histogram_lines("dao_statement_duration_seconds",
+                                         f"statement=\"{prometheus_label(shape)}\"", histogram)
+
+            lines.append("# TYPE dao_transaction_duration_seconds histogram")
+            lines += histogram_lines("dao_transaction_duration_seconds", "", self._transactions)
+
+            lines.append("# TYPE dao_slow_queries_total counter")
+            lines.append(f"dao_slow_queries_total {self.slow_queries}")
+        return "\n".join(lines) + "\n"
+
+
+def sqlite_memory_library():
+    # the sqlite library behind the sqlite3 module, for sqlite3_memory_used/highwater; None if unreachable
+    try:
+        import ctypes
+        import _sqlite3
+        library = ctypes.CDLL(_sqlite3.__file__)
+        library.sqlite3_memory_used.restype = ctypes.c_int64
+        library.sqlite3_memory_highwater.restype = ctypes.c_int64
+        library.sqlite3_memory_highwater.argtypes = (ctypes.c_int,)
+    except (ImportError, OSError, AttributeError):
+        return None
+    return library
+
+
+class MemoryMetrics(QueryMetrics):
+    # QueryMetrics plus peak memory per DAO call and per statement shape: Python allocations traced by
+    # tracemalloc and sqlite's own allocator high-water mark, both above their level when the call or
+    # statement started. Both are process-wide, so calls running at the same time in other threads are
+    # counted in. Calls whose peaks add up to more than budget bytes are counted and logged.
+    # Opt in with DataBaseConnection.enable_metrics(MemoryMetrics(...)); close() stops tracemalloc
+    # if this instance started it
+
+    def __init__(self, slow_threshold: float = .1, budget: int = 64 * 2 ** 20):
+        super().__init__(slow_threshold)
+        self.budget = budget
+        self.over_budget = 0
+        self._sqlite = sqlite_memory_library()
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        self._memory = {"methods": dict(), "statements": dict()}
+
+    def close(self):
+        if self._started and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started = False
+
+    def reset(self):
+        super().reset()
+        with self._lock:
+            self.over_budget = 0
+            self._memory = {"methods": dict(), "statements": dict()}
+
+    def _start_peaks(self) -> tuple:
+        # current levels, with both high-water marks brought down to them
+        tracemalloc.reset_peak()
+        if self._sqlite:
+            self._sqlite.sqlite3_memory_highwater(1)
+            return tracemalloc.get_traced_memory()[0], self._sqlite.sqlite3_memory_used()
+        return tracemalloc.get_traced_memory()[0], 0
+
+    def _fold_peaks(self) -> tuple:
+        # high-water marks since the last _start_peaks, kept as the running call maximum
+        local = self._local
+        python = tracemalloc.get_traced_memory()[1]
+        sqlite = self._sqlite.sqlite3_memory_highwater(0) if self._sqlite else 0
+        local.peaks = (max(local.peaks[0], python), max(local.peaks[1], sqlite))
+        return python, sqlite
+
+    def _observe_memory(self, kind: str, key: str, python: int, sqlite: int):
+        with self._lock:
+            if key not in self._memory[kind]:
+                self._memory[kind][key] = (Histogram(MEMORY_BUCKETS), Histogram(MEMORY_BUCKETS))
+            self._memory[kind][key][0].observe(python)
+            self._memory[kind][key][1].observe(sqlite)
+
+    def _close_statement(self, now: float):
+        local = self._local
+        current = getattr(local, "statement", None)
+        super()._close_statement(now)
+        if current is not None and getattr(local, "call_base", None) is not None:
+            python, sqlite = self._fold_peaks()
+            self._observe_memory("statements", current[0], python - local.statement_base[0],
+                                 sqlite - local.statement_base[1])
+
+    def trace(self, statement: str):
+        super().trace(statement)
+        local = self._local
+        if getattr(local, "depth", 0) and getattr(local, "call_base", None) is not None:
+            local.statement_base = self._start_peaks()
+
+    def measure(self, name: str, method, *args, **kwargs):
+        local = self._local
+        if not getattr(local, "depth", 0):
+            # the outermost DAO call owns the peaks; nested calls are part of it
+            local.call_base = local.statement_base = local.peaks = self._start_peaks()
+        return super().measure(name, method, *args, **kwargs)
+
+    def record_call(self, name: str, duration: float, result=None):
+        super().record_call(name, duration, result)
+        local = self._local
+        if getattr(local, "depth", 0) or getattr(local, "call_base", None) is None:
+            return
+        self._fold_peaks()
+        python = local.peaks[0] - local.call_base[0]
+        sqlite = local.peaks[1] - local.call_base[1]
+        local.call_base = None
+        self._observe_memory("methods", name, python, sqlite)
+
+        if python + sqlite > self.budget:
+            with self._lock:
+                self.over_budget += 1
+            rows = len(result) if isinstance(result, list) else 0
+            statements = "; ".join(getattr(local, "traced", ()))
+            memory_log.warning("%s peaked at %d bytes Python, %d bytes sqlite (%d rows): %s",
+                               name, python, sqlite, rows, statements)
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        with self._lock:
+            snapshot["memory"] = {
+                kind: {
+                    key: {"python": python.snapshot(), "sqlite": sqlite.snapshot()}
+                    for key, (python, sqlite) in histograms.items()
+                }
+                for kind, histograms in self._memory.items()
+            }
+            snapshot["memory"]["over_budget"] = self.over_budget
+            snapshot["memory"]["sqlite_tracked"] = self._sqlite is not None
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        lines = [super().to_prometheus().rstrip("\n")]
+        with self._lock:
+            for kind, label in (("methods", "method"), ("statements", "statement")):
+                for source, position in (("python", 0), ("sqlite", 1)):
+                    metric = f"dao_{kind[:-1]}_{source}_peak_bytes"
+                    lines.append(f"# TYPE {metric} histogram")
+                    for key, histograms in self._memory[kind].items():
+                        lines += histogram_lines(metric, f"{label}=\"{prometheus_label(key)}\"",
+                                                 histograms[position])
+            lines.append("# TYPE dao_over_budget_total counter")
+            lines.append(f"dao_over_budget_total {self.over_budget}")
+        return "\n".join(lines) + "\n"
+
+
+def instrumented(method):
+    # DAO method decorator; costs one attribute lookup while metrics are disabled
+    name = method.__qualname__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = getattr(self._dbcon, "metrics", None)
+        if metrics is None:
+            return method(self, *args, **kwargs)
+        return metrics.measure(name, method, self, *args, **kwargs)
+
+    return wrapper
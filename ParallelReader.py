@@ -0,0 +1,97 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from DataBaseConnection import ConnectionHolder
+from DAOFactoryMethod import DAOFactory, ResortDAO, FeatureDAO, EnvironmentDAO, RoleDAO
+
+
+TABLES = {
+    ResortDAO: "resorts",
+    FeatureDAO: "features",
+    EnvironmentDAO: "environments",
+    RoleDAO: "roles"
+}
+
+_worker_dbcon: ConnectionHolder = None
+
+
+def _init_worker(db_file_path: str):
+    global _worker_dbcon
+    _worker_dbcon = ConnectionHolder(sqlite3.connect(f"file:{db_file_path}?mode=ro", uri=True))
+
+
+def _filter_range(dao_class, params: list, low: int, high: int) -> list:
+    range_params = [
+        {
+            "column": "id",
+            "value": low,
+            "op": ">="
+        },
+        {
+            "column": "id",
+            "value": high,
+            "op": "<"
+        }
+    ]
+    rows = dao_class(_worker_dbcon).filter(list(params) + range_params)
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+class ParallelReader:
+
+    def __init__(self, db_file_path: str, workers: int = None, chunks_per_worker: int = 4):
+        self._db_file_path = db_file_path
+        self._workers = workers or os.cpu_count() or 1
+        self._chunks = self._workers * chunks_per_worker
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(self._workers, initializer=_init_worker,
+                                                 initargs=(self._db_file_path,))
+        return self._executor
+
+    def _ranges(self, table: str) -> list:
+        con = sqlite3.connect(f"file:{self._db_file_path}?mode=ro", uri=True)
+        try:
+            low, high = con.execute(f"select min(id), max(id) from {table}").fetchone()
+        finally:
+            con.close()
+        if low is None:
+            return list()
+        step = max(1, -(-(high - low + 1) // self._chunks))
+        return [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+
+    def iterate(self, dao_factory: DAOFactory, params: list = ()):
+        # yields rows in id order, one id range at a time, while later ranges are still being read
+        dao_class = type(dao_factory.create_DAO())
+        if dao_class not in TABLES:
+            raise ValueError(f"{dao_class.__name__} does not support parallel reads.")
+
+        ranges = self._ranges(TABLES[dao_class])
+        chunks = self._get_executor().map(_filter_range,
+                                          [dao_class] * len(ranges),
+                                          [list(params)] * len(ranges),
+                                          [low for low, _ in ranges],
+                                          [high for _, high in ranges])
+        for chunk in chunks:
+            yield from chunk
+
+    def filter(self, dao_factory: DAOFactory, params: list) -> list:
+        return list(self.iterate(dao_factory, params))
+
+    def get_all(self, dao_factory: DAOFactory) -> list:
+        return list(self.iterate(dao_factory))
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,180 @@
+import heapq
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from SubjectObserver import Observer, Subject
+from DataBaseConnection import DataBaseConnection
+from DAOFactoryMethod import ResortDAO, FeatureDAO, EnvironmentDAO
+
+
+class PriceIndex(Observer):
+    # (price, id) pairs kept sorted in two parallel arrays, plus name -> resort ids sets
+    # for feature/environment constraints; kept current as a DAO observer
+
+    def __init__(self, dbcon: DataBaseConnection = None):
+        self._dbcon = dbcon
+        self._prices = array("d")
+        self._ids = array("q")
+        self._price_by_id = dict()
+        self._features = dict()
+        self._environments = dict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def load(self):
+        con = self._dbcon.get_read_connection()
+        self._prices = array("d")
+        self._ids = array("q")
+        self._price_by_id = dict()
+        self._features = dict()
+        self._environments = dict()
+
+        with con:
+            for id_, price in con.execute("select id, price from resorts order by price, id"):
+                self._prices.append(price)
+                self._ids.append(id_)
+                self._price_by_id[id_] = price
+            for resort_id, name in con.execute("""select resort_id, features.name from resort_features
+                    join features on features.id = resort_features.feature_id"""):
+                self._features.setdefault(name, set()).add(resort_id)
+            for resort_id, name in con.execute("""select resort_id, environments.name from resort_environments
+                    join environments on environments.id = resort_environments.environment_id"""):
+                self._environments.setdefault(name, set()).add(resort_id)
+
+    def subscribe(self):
+        for dao_class in (ResortDAO, FeatureDAO, EnvironmentDAO):
+            dao = dao_class(self._dbcon)
+            if self not in dao._observers:
+                dao.attach(self)
+
+    def unsubscribe(self):
+        for dao_class in (ResortDAO, FeatureDAO, EnvironmentDAO):
+            dao = dao_class(self._dbcon)
+            if self in dao._observers:
+                dao.detach(self)
+
+    def _position(self, id_: int) -> int:
+        price = self._price_by_id[id_]
+        position = bisect_left(self._prices, price)
+        while self._ids[position] != id_:
+            position += 1
+        return position
+
+    def add(self, id_: int, price: float, features=(), environments=()):
+        if id_ in self._price_by_id:
+            self.remove(id_)
+        position = bisect_right(self._prices, price)
+        self._prices.insert(position, price)
+        self._ids.insert(position, id_)
+        self._price_by_id[id_] = price
+        for name in features:
+            self._features.setdefault(name, set()).add(id_)
+        for name in environments:
+            self._environments.setdefault(name, set()).add(id_)
+
+    def remove(self, id_: int):
+        if id_ not in self._price_by_id:
+            return
+        position = self._position(id_)
+        del self._prices[position]
+        del self._ids[position]
+        del self._price_by_id[id_]
+        for ids in self._features.values():
+            ids.discard(id_)
+        for ids in self._environments.values():
+            ids.discard(id_)
+
+    def set_price(self, id_: int, price: float):
+        if id_ not in self._price_by_id:
+            return
+        position = self._position(id_)
+        del self._prices[position]
+        del self._ids[position]
+        position = bisect_right(self._prices, price)
+        self._prices.insert(position, price)
+        self._ids.insert(position, id_)
+        self._price_by_id[id_] = price
+
+    def update(self, subject: Subject) -> None:
+        action = subject._last_action
+        if isinstance(subject, ResortDAO):
+            if action["action"] == "add":
+                resort = action["object"]
+                self.add(action["id"], resort.price, resort.feature_ids, resort.environment_ids)
+            elif action["action"] == "remove":
+                for id_ in action["ids"]:
+                    self.remove(id_)
+            elif action["action"] == "update":
+                for id_ in action["ids"]:
+                    self.set_price(id_, action["new"].price)
+            return
+
+        names = self._features if isinstance(subject, FeatureDAO) else self._environments
+        if action["action"] == "remove":
+            names.pop(action["object"].name, None)
+        elif action["action"] == "update" and action["old"].name in names:
+            names.setdefault(action["new"].name, set()).update(names.pop(action["old"].name))
+
+    def range(self, low: float = None, high: float = None, include_low: bool = True,
+              include_high: bool = False) -> list:
+        # (price, id) pairs ordered by price, low <= price < high by default
+        start = 0
+        end = len(self._prices)
+        if low is not None:
+            start = (bisect_left if include_low else bisect_right)(self._prices, low)
+        if high is not None:
+            end = (bisect_right if include_high else bisect_left)(self._prices, high)
+        return list(zip(self._prices[start:end], self._ids[start:end]))
+
+    def _candidates(self, features, environments):
+        candidates = None
+        for names, index in ((features, self._features), (environments, self._environments)):
+            for name in names:
+                ids = index.get(name, set())
+                candidates = set(ids) if candidates is None else candidates & ids
+        return candidates
+
+    def _top(self, k: int, features, environments, largest: bool) -> list:
+        candidates = self._candidates(features, environments)
+        if candidates is None:
+            size = len(self._ids)
+            positions = range(size - 1, max(size - k, 0) - 1, -1) if largest else range(min(k, size))
+            return [(self._prices[position], self._ids[position]) for position in positions]
+
+        if len(candidates) * 8 < len(self._ids):
+            # few candidates: bounded heap over them instead of walking the price order
+            pairs = ((self._price_by_id[id_], id_) for id_ in candidates)
+            return (heapq.nlargest if largest else heapq.nsmallest)(k, pairs)
+
+        found = list()
+        order = range(len(self._ids) - 1, -1, -1) if largest else range(len(self._ids))
+        for position in order:
+            if self._ids[position] in candidates:
+                found.append((self._prices[position], self._ids[position]))
+                if len(found) == k:
+                    break
+        return found
+
+    def cheapest(self, k: int, features=(), environments=()) -> list:
+        return self._top(k, features, environments, largest=False)
+
+    def most_expensive(self, k: int, features=(), environments=()) -> list:
+        return self._top(k, features, environments, largest=True)
+
+    def memory_bytes(self) -> int:
+        size = self._prices.buffer_info()[1] * self._prices.itemsize
+        size += self._ids.buffer_info()[1] * self._ids.itemsize
+        size += sys.getsizeof(self._price_by_id)
+        # boxed id and price objects held by the dict
+        size += len(self._price_by_id) * (sys.getsizeof(2 ** 40) + sys.getsizeof(.0))
+        for index in (self._features, self._environments):
+            size += sys.getsizeof(index)
+            size += sum(sys.getsizeof(ids) for ids in index.values())
+        return size
+
+    def memory_per_million(self) -> float:
+        if not self._ids:
+            return .0
+        return self.memory_bytes() / len(self._ids) * 1_000_000
@@ -0,0 +1,141 @@
+import sqlite3
+import time
+
+from DataBaseConnection import DataBaseConnection
+
+
+# table: (changelog key column, columns copied to the replica)
+REPLICATED_TABLES = {
+    "resorts": ("id", "id, name, price, version"),
+    "features": ("id", "id, name, version"),
+    "environments": ("id", "id, name, version"),
+    "resort_features": ("resort_id", "resort_id, feature_id"),
+    "resort_environments": ("resort_id", "resort_id, environment_id"),
+    # copied as is; the replica's own resort_view triggers are dropped, a delete plus insert of a
+    # resort would otherwise reset its features and environments there
+    "resort_view": ("id", "id, name, price, features, environments")
+}
+
+CREATE_CHANGELOG = ["""
+create table if not exists changelog (
+    seq integer primary key autoincrement,
+    tbl text not null,
+    row_id integer not null,
+    created real not null default (julianday('now'))
+);"""]
+
+for _table, (_key, _) in REPLICATED_TABLES.items():
+    CREATE_CHANGELOG += [
+        f"""
+create trigger if not exists changelog_{_table}_insert after insert on {_table} begin
+    insert into changelog (tbl, row_id) values ('{_table}', new.{_key});
+end;""",
+        f"""
+create trigger if not exists changelog_{_table}_update after update on {_table} begin
+    insert into changelog (tbl, row_id) values ('{_table}', new.{_key});
+    insert into changelog (tbl, row_id) select '{_table}', old.{_key} where old.{_key} != new.{_key};
+end;""",
+        f"""
+create trigger if not exists changelog_{_table}_delete after delete on {_table} begin
+    insert into changelog (tbl, row_id) values ('{_table}', old.{_key});
+end;"""
+    ]
+
+
+def install_changelog(dbcon: DataBaseConnection):
+    # run once on the primary; every write to a replicated table is then logged
+    con = dbcon.get_connection()
+    with con:
+        for statement in CREATE_CHANGELOG:
+            con.execute(statement)
+
+
+def prune_changelog(dbcon: DataBaseConnection, older_than: float = 3600.0):
+    # replicas that fall behind the pruned range reload from scratch
+    con = dbcon.get_connection()
+    with con:
+        con.execute("delete from changelog where created < julianday('now') - :days",
+                    {"days": older_than / 86400.0})
+
+
+class ReadReplica:
+
+    def __init__(self, db_file_path: str, max_staleness: float = 1.0):
+        self._db_file_path = db_file_path
+        self._max_staleness = max_staleness
+        self._primary = None
+        self._connection = None
+        self._last_seq = 0
+        self._refreshed = .0
+        self._seen_changes = None
+
+    def load(self):
+        # full copy of the primary into :memory:
+        self.close()
+        self._primary = sqlite3.connect(f"file:{self._db_file_path}?mode=ro", uri=True)
+        self._connection = sqlite3.connect(":memory:")
+        with self._primary:
+            self._last_seq = self._primary.execute("select coalesce(max(seq), 0) from changelog").fetchone()[0]
+            self._primary.backup(self._connection)
+
+        with self._connection:
+            triggers = self._connection.execute(
+                "select name from sqlite_master where type='trigger' "
+                "and (name like 'changelog_%' or name like 'resort_view_%')").fetchall()
+            for name, in triggers:
+                self._connection.execute(f"drop trigger {name}")
+        self._refreshed = time.monotonic()
+
+    def refresh(self):
+        # applies primary writes logged after the last refresh
+        if not self._connection:
+            raise ValueError("Replica not loaded.")
+
+        changes = self._primary.execute(
+            "select seq, tbl, row_id from changelog where seq > ? order by seq", (self._last_seq,)).fetchall()
+        if changes and changes[0][0] > self._last_seq + 1:
+            # changelog was pruned past our position
+            self.load()
+            return
+
+        pending = dict()
+        for seq, tbl, row_id in changes:
+            pending.setdefault(tbl, set()).add(row_id)
+            self._last_seq = seq
+
+        with self._connection:
+            for tbl, row_ids in pending.items():
+                key, columns = REPLICATED_TABLES[tbl]
+                for row_id in row_ids:
+                    rows = self._primary.execute(
+                        f"select {columns} from {tbl} where {key}=?", (row_id,)).fetchall()
+                    self._connection.execute(f"delete from {tbl} where {key}=?", (row_id,))
+                    if rows:
+                        placeholders = ", ".join("?" * len(rows[0]))
+                        self._connection.executemany(
+                            f"insert into {tbl} ({columns}) values ({placeholders})", rows)
+        self._refreshed = time.monotonic()
+
+    def get_connection(self, primary: sqlite3.Connection = None) -> sqlite3.Connection:
+        # primary: writer connection of this process; its own writes are visible immediately
+        if not self._connection:
+            raise ValueError("Replica not loaded.")
+
+        if primary is not None:
+            if primary.in_transaction:
+                return primary
+            if primary.total_changes != self._seen_changes:
+                self._seen_changes = primary.total_changes
+                self.refresh()
+                return self._connection
+
+        if time.monotonic() - self._refreshed > self._max_staleness:
+            self.refresh()
+        return self._connection
+
+    def close(self):
+        for con in (self._connection, self._primary):
+            if con:
+                con.close()
+        self._connection = None
+        self._primary = None
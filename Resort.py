@@ -1,9 +1,11 @@
 class Resort:
-    def __init__(self, name: str = "", price: float = .0, feature_ids: set = set(), environment_ids: set = set()):
+    def __init__(self, name: str = "", price: float = .0, feature_ids: set = set(), environment_ids: set = set(),
+                 version: int = None):
         self.name: str = name
         self.price: float = price
         self.feature_ids: set = feature_ids
         self.environment_ids: set = environment_ids
+        self.version: int = version
 
 
 class ResortBuilder:
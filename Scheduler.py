@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from Metrics import Histogram, histogram_lines, prometheus_label
+
+
+class AdmissionError(Exception):
+    # a call was turned away: its role's queue was full, or it waited longer than allowed
+    def __init__(self, role: str, reason: str):
+        super().__init__(f"{role} call not admitted: {reason}.")
+        self.role = role
+        self.reason = reason
+
+
+class _Ticket:
+    def __init__(self):
+        self.granted = threading.Event()
+        self.enqueued = time.monotonic()
+
+
+class _RoleQueue:
+    def __init__(self, weight: float, concurrency: int, max_queue: int):
+        self.weight = weight
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.waiting = deque()
+        self.running = 0
+        self.virtual_time = .0
+        self.max_depth = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waits = Histogram()
+
+
+class RoleScheduler:
+    # gate in front of the DAO calls made through DAOProxy: each call waits in its role's queue until
+    # one of `concurrency` slots is free. Waiting roles are served by weighted fair queueing (stride
+    # scheduling over a virtual time), each role may hold at most its own number of slots, and a call
+    # is refused when its role's queue is full or its wait exceeds the timeout. Calls run in the
+    # caller's thread, so connections stay with the threads that opened them
+
+    def __init__(self, weights: dict = None, concurrency: int = 1, role_concurrency: dict = None,
+                 max_queue: dict = None):
+        weights = weights or {"user": 4.0, "admin": 1.0}
+        role_concurrency = role_concurrency or dict()
+        max_queue = max_queue or {"user": 256, "admin": 1024}
+        self._concurrency = concurrency
+        self._running = 0
+        self._virtual_time = .0
+        self._lock = threading.Lock()
+        self._roles = {
+            role: _RoleQueue(weight, role_concurrency.get(role, concurrency), max_queue.get(role, 256))
+            for role, weight in weights.items()
+        }
+
+    def _dispatch(self):
+        # under self._lock: hand free slots to the eligible role that is furthest behind
+        while self._running < self._concurrency:
+            eligible = [queue for queue in self._roles.values()
+                        if queue.waiting and queue.running < queue.concurrency]
+            if not eligible:
+                return
+            queue = min(eligible, key=lambda queue: queue.virtual_time)
+            ticket = queue.waiting.popleft()
+            self._virtual_time = queue.virtual_time
+            queue.virtual_time += 1.0 / queue.weight
+            queue.running += 1
+            self._running += 1
+            queue.admitted += 1
+            queue.waits.observe(time.monotonic() - ticket.enqueued)
+            ticket.granted.set()
+
+    def _release(self, queue: _RoleQueue):
+        with self._lock:
+            queue.running -= 1
+            self._running -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, role: str, timeout: float = None):
+        # `with scheduler.slot(role, timeout):` around one DAO call
+        queue = self._roles[role]
+        ticket = _Ticket()
+        with self._lock:
+            if len(queue.waiting) >= queue.max_queue:
+                queue.rejected += 1
+                raise AdmissionError(role, "queue full")
+            if not queue.waiting and not queue.running:
+                # an idle role rejoins at the current virtual time instead of spending saved credit
+                queue.virtual_time = max(queue.virtual_time, self._virtual_time)
+            queue.waiting.append(ticket)
+            queue.max_depth = max(queue.max_depth, len(queue.waiting))
+            self._dispatch()
+
+        if not ticket.granted.wait(timeout):
+            with self._lock:
+                if not ticket.granted.is_set():
+                    queue.waiting.remove(ticket)
+                    queue.timed_out += 1
+                    raise AdmissionError(role, f"waited over {timeout:.3f}s")
+        try:
+            yield
+        finally:
+            self._release(queue)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                role: {
+                    "depth": len(queue.waiting),
+                    "max_depth": queue.max_depth,
+                    "running": queue.running,
+                    "admitted": queue.admitted,
+                    "rejected": queue.rejected,
+                    "timed_out": queue.timed_out,
+                    "wait": queue.waits.snapshot()
+                }
+                for role, queue in self._roles.items()
+            }
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            lines = list()
+            for metric, kind, value in (("dao_queue_depth", "gauge", lambda queue: len(queue.waiting)),
+                                        ("dao_queue_running", "gauge", lambda queue: queue.running),
+                                        ("dao_queue_admitted_total", "counter", lambda queue: queue.admitted),
+                                        ("dao_queue_rejected_total", "counter", lambda queue: queue.rejected),
+                                        ("dao_queue_timed_out_total", "counter", lambda queue: queue.timed_out)):
+                lines.append(f"# TYPE {metric} {kind}")
+                for role, queue in self._roles.items():
+                    lines.append(f"{metric}{{role=\"{prometheus_label(role)}\"}} {value(queue)}")
+            lines.append("# TYPE dao_queue_wait_seconds histogram")
+            for role, queue in self._roles.items():
+                lines += histogram_lines("dao_queue_wait_seconds", f"role=\"{prometheus_label(role)}\"", queue.waits)
+        return "\n".join(lines) + "\n"
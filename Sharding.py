@@ -0,0 +1,303 @@
+import heapq
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, zip_longest
+
+import Resort
+from SubjectObserver import Subject, Observer
+from DataBaseConnection import ConnectionHolder, apply_profile, migrate
+from DAOFactoryMethod import DAO, ResortDAO, ConcurrentUpdateError, name_ids
+
+
+# resort ids carry their shard: id = shard << SHARD_ID_BITS | local sequence
+SHARD_ID_BITS = 40
+
+# small tables copied to every shard; shard 0 is the source of truth
+REPLICATED_TABLES = ("features", "environments", "roles", "users")
+
+RESORT_COLUMNS = ("id", "name", "price")
+
+
+def resort_name_key(resort: Resort.Resort) -> int:
+    return zlib.crc32(resort.name.encode())
+
+
+class ShardConnection(ConnectionHolder):
+    # one shard's connection, shared by the scatter-gather threads under a lock
+
+    def __init__(self, connection: sqlite3.Connection = None):
+        super().__init__(connection)
+        self.lock = threading.RLock()
+
+
+class ShardedDataBaseConnection(object):
+    sharded: bool = True
+
+    def __init__(self, db_file_paths: list, shard_key=resort_name_key, profile: str = "durable",
+                 workers: int = None):
+        if not db_file_paths:
+            raise ValueError("No shards.")
+        self._db_file_paths = list(db_file_paths)
+        self._shard_key = shard_key
+        self._profile = profile
+        self._workers = workers or len(self._db_file_paths)
+        self._executor = None
+        # serializes resort name checks with the writes that depend on them, across shards
+        self.names_lock = threading.Lock()
+        self.shards = list()
+
+    def open_connection(self):
+        if self.shards:
+            raise ConnectionError("Close previous connection.")
+
+        for index, db_file_path in enumerate(self._db_file_paths):
+            con = sqlite3.connect(db_file_path, check_same_thread=False)
+            apply_profile(con, self._profile)
+            migrate(con)
+            with con:
+                # start this shard's resort ids in its own id block
+                con.execute("insert into sqlite_sequence (name, seq) select 'resorts', :seq "
+                            "where not exists (select 1 from sqlite_sequence where name = 'resorts')",
+                            {"seq": index << SHARD_ID_BITS})
+                con.execute("update sqlite_sequence set seq = :seq where name = 'resorts' and seq < :seq",
+                            {"seq": index << SHARD_ID_BITS})
+            self.shards.append(ShardConnection(con))
+        self._executor = ThreadPoolExecutor(self._workers)
+        self.sync_replicated()
+
+    def close_connection(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        for shard in self.shards:
+            shard.close_connection()
+        self.shards = list()
+
+    def shard_for(self, resort: Resort.Resort) -> ShardConnection:
+        return self.shards[self._shard_key(resort) % len(self.shards)]
+
+    def shard_for_id(self, resort_id: int) -> ShardConnection:
+        return self.shards[resort_id >> SHARD_ID_BITS]
+
+    def scatter(self, function) -> list:
+        # function(shard) on every shard in parallel, results in shard order
+        def locked(shard):
+            with shard.lock:
+                return function(shard)
+
+        return list(self._executor.map(locked, self.shards))
+
+    def sync_replicated(self, tables: tuple = REPLICATED_TABLES):
+        source = self.shards[0]
+        with source.lock:
+            snapshot = dict()
+            for table in tables:
+                cursor = source.connection.execute(f"select * from {table}")
+                snapshot[table] = ([column[0] for column in cursor.description], cursor.fetchall())
+
+        for shard in self.shards[1:]:
+            with shard.lock, shard.connection as con:
+                for table, (columns, rows) in snapshot.items():
+                    ids = [(row[0],) for row in rows]
+                    con.execute("create temp table if not exists keep_ids (id integer primary key)")
+                    con.execute("delete from keep_ids")
+                    con.executemany("insert into keep_ids (id) values (?)", ids)
+                    con.execute(f"delete from {table} where id not in (select id from keep_ids)")
+                    placeholders = ", ".join("?" * len(columns))
+                    updates = ", ".join(f"{column}=excluded.{column}" for column in columns[1:])
+                    changed = " or ".join(f"{column} is not excluded.{column}" for column in columns[1:])
+                    # unchanged rows are left alone, so their triggers (FTS, resort_view) do not fire
+                    con.executemany(f"insert into {table} ({', '.join(columns)}) values ({placeholders}) "
+                                    f"on conflict(id) do update set {updates} where {changed}", rows)
+
+    def create_DAO(self, dao_class) -> DAO:
+        if dao_class is ResortDAO:
+            return ShardedResortDAO(self)
+        return ReplicatedDAO(self, dao_class)
+
+
+class ShardedResortDAO(DAO, Subject):
+    # observers are ResortDAO's; the per-shard DAOs notify them with global ids
+
+    def __init__(self, dbcon: ShardedDataBaseConnection = None):
+        self._dbcon = dbcon
+
+    def _merge(self, results: list, order_by: str, descending: bool, limit: int) -> list:
+        column = RESORT_COLUMNS.index(order_by)
+        ordered = [sorted(rows, key=lambda row: row[column], reverse=descending) for rows in results]
+        merged = heapq.merge(*ordered, key=lambda row: row[column], reverse=descending)
+        return list(islice(merged, limit))
+
+    def get_all(self, order_by: str = "id", descending: bool = False, limit: int = None) -> list:
+        results = self._dbcon.scatter(lambda shard: ResortDAO(shard).get_all())
+        return self._merge(results, order_by, descending, limit)
+
+    def filter(self, params: list, order_by: str = "id", descending: bool = False, limit: int = None) -> list:
+        results = self._dbcon.scatter(lambda shard: ResortDAO(shard).filter(params))
+        return self._merge(results, order_by, descending, limit)
+
+    def get_all_view(self) -> list:
+        return self.filter_view([])
+
+    def filter_view(self, params: list) -> list:
+        results = self._dbcon.scatter(lambda shard: ResortDAO(shard).filter_view(params))
+        return self._merge(results, "id", False, None)
+
+    def rebuild_view(self):
+        self._dbcon.scatter(lambda shard: ResortDAO(shard).rebuild_view())
+
+    def iterate_with_names(self, batch_size: int = 1000):
+        # shard by shard, which is id order; each shard's lock is held only while a batch is read
+        for shard in self._dbcon.shards:
+            rows = ResortDAO(shard).iterate_with_names(batch_size)
+            while True:
+                with shard.lock:
+                    batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                yield from batch
+
+    def search(self, text: str, limit: int = 10, prefix: bool = True) -> list:
+        # ranks are per shard and not comparable across shards, so the shards' results are interleaved
+        results = self._dbcon.scatter(lambda shard: ResortDAO(shard).search(text, limit, prefix))
+        interleaved = (row for rows in zip_longest(*results) for row in rows if row is not None)
+        return list(islice(interleaved, limit))
+
+    def rebuild_search_index(self):
+        self._dbcon.scatter(lambda shard: ResortDAO(shard).rebuild_search_index())
+
+    def get_all_json(self) -> bytes:
+        return self.filter_json([])
+
+    def filter_json(self, params: list) -> bytes:
+        results = self._dbcon.scatter(lambda shard: ResortDAO(shard).filter_json(params))
+        return b"[" + b",".join(payload[1:-1] for payload in results if payload != b"[]") + b"]"
+
+    def iterate_json(self, params: list = (), chunk_rows: int = 1000):
+        # the shards' chunks re-joined into one array; every chunk but the closing one starts with "[" or ","
+        separator = b"["
+        for shard in self._dbcon.shards:
+            chunks = ResortDAO(shard).iterate_json(params, chunk_rows)
+            while True:
+                with shard.lock:
+                    chunk = next(chunks)
+                if chunk in (b"]", b"[]"):
+                    break
+                yield separator + chunk[1:]
+                separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+
+    def versions(self, params: list) -> list:
+        results = self._dbcon.scatter(lambda shard: ResortDAO(shard).versions(params))
+        return [row for rows in results for row in rows]
+
+    def _owners(self, names: list) -> dict:
+        # name -> shard already holding that resort; renamed rows stay off their name's shard
+        found = self._dbcon.scatter(lambda shard: name_ids(shard.connection, "resorts", names))
+        return {name: shard for shard, ids in zip(self._dbcon.shards, found) for name in ids}
+
+    def add(self, resort: Resort.Resort):
+        with self._dbcon.names_lock:
+            if self._owners([resort.name]):
+                raise sqlite3.IntegrityError("UNIQUE constraint failed: resorts.name")
+            shard = self._dbcon.shard_for(resort)
+            with shard.lock:
+                ResortDAO(shard).add(resort)
+
+    def upsert(self, resort: Resort.Resort) -> int:
+        return self.upsert_many([resort])[resort.name]
+
+    def upsert_many(self, resorts: list) -> dict:
+        # existing names are upserted where they live, new ones go to their name's shard
+        with self._dbcon.names_lock:
+            owners = self._owners(list({resort.name for resort in resorts}))
+            by_shard = dict()
+            for resort in resorts:
+                shard = owners.get(resort.name) or self._dbcon.shard_for(resort)
+                by_shard.setdefault(shard, list()).append(resort)
+            ids = dict()
+            for shard, shard_resorts in by_shard.items():
+                with shard.lock:
+                    ids.update(ResortDAO(shard).upsert_many(shard_resorts))
+        return ids
+
+    def remove(self, object_):
+        self._dbcon.scatter(lambda shard: ResortDAO(shard).remove(object_))
+
+    def update(self, object_old: Resort.Resort, object_new: Resort.Resort):
+        # sent only to the shards holding object_old; a pinned version conflicts when none does
+        params = [
+            {"column": "name", "value": object_old.name, "op": "="},
+            {"column": "price", "value": object_old.price, "op": "="}
+        ]
+        with self._dbcon.names_lock:
+            if object_new.name != object_old.name and self._owners([object_new.name]):
+                raise sqlite3.IntegrityError("UNIQUE constraint failed: resorts.name")
+            found = self._dbcon.scatter(lambda shard: ResortDAO(shard).versions(params))
+            owners = [shard for shard, rows in zip(self._dbcon.shards, found) if rows]
+            if not owners and getattr(object_old, "version", None) is not None:
+                raise ConcurrentUpdateError("resorts")
+            for shard in owners:
+                with shard.lock:
+                    ResortDAO(shard).update(object_old, object_new)
+
+    def attach(self, observer: Observer) -> None:
+        ResortDAO(None).attach(observer)
+
+    def detach(self, observer: Observer) -> None:
+        ResortDAO(None).detach(observer)
+
+    def notify(self) -> None:
+        ResortDAO(None).notify()
+
+
+class ReplicatedDAO(DAO):
+    # reads from shard 0, writes to shard 0 and then copies the written table to the other shards
+
+    def __init__(self, dbcon: ShardedDataBaseConnection, dao_class):
+        self._dbcon = dbcon
+        self._dao_class = dao_class
+
+    def _source(self) -> DAO:
+        return self._dao_class(self._dbcon.shards[0])
+
+    def _write(self, method: str, *args):
+        with self._dbcon.shards[0].lock:
+            result = getattr(self._source(), method)(*args)
+        self._dbcon.sync_replicated((self._dao_class._table,))
+        return result
+
+    def get_all(self) -> list:
+        with self._dbcon.shards[0].lock:
+            return self._source().get_all()
+
+    def filter(self, params: list) -> list:
+        with self._dbcon.shards[0].lock:
+            return self._source().filter(params)
+
+    def versions(self, params: list) -> list:
+        with self._dbcon.shards[0].lock:
+            return self._source().versions(params)
+
+    def add(self, object_):
+        return self._write("add", object_)
+
+    def upsert(self, object_):
+        return self._write("upsert", object_)
+
+    def upsert_many(self, objects: list):
+        return self._write("upsert_many", objects)
+
+    def remove(self, object_):
+        return self._write("remove", object_)
+
+    def update(self, object_old, object_new):
+        return self._write("update", object_old, object_new)
+
+    def attach(self, observer: Observer) -> None:
+        self._dao_class(None).attach(observer)
+
+    def detach(self, observer: Observer) -> None:
+        self._dao_class(None).detach(observer)
@@ -0,0 +1,287 @@
+import heapq
+import json
+import random
+import sys
+from array import array
+from bisect import bisect_left, insort
+
+from SubjectObserver import Observer, Subject
+from DataBaseConnection import DataBaseConnection
+from DAOFactoryMethod import ResortDAO, FeatureDAO, EnvironmentDAO
+
+
+# Mersenne prime for the (a * x + b) % P permutations; signatures keep the low 32 bits
+PRIME = (1 << 61) - 1
+
+
+class SimilarityIndex(Observer):
+    # resorts that share a feature/environment set share a profile; each profile has a MinHash
+    # signature, bucketed per LSH band, and its resort ids sorted by price.
+    # similar() looks up candidate profiles through the bands and re-ranks them by exact Jaccard
+    # similarity, then by price distance; kept current as a DAO observer
+
+    def __init__(self, dbcon: DataBaseConnection = None, num_perm: int = 48, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands.")
+        self._dbcon = dbcon
+        self._num_perm = num_perm
+        self._bands_count = bands
+        self._rows = num_perm // bands
+        generator = random.Random(seed)
+        self._permutations = [(generator.randrange(1, PRIME), generator.randrange(PRIME)) for _ in range(num_perm)]
+        self._clear()
+
+    def _clear(self):
+        self._tokens = dict()  # ("f" | "e", name) -> token
+        self._hashes = list()  # token -> its num_perm hash values
+        self._profile_ids = dict()  # sorted token tuple -> profile
+        self._profiles = list()  # profile -> sorted token tuple, None when free
+        self._members = list()  # profile -> resort ids sorted by price
+        self._signatures = array("I")  # num_perm values per profile
+        self._free = list()
+        self._bands = [dict() for _ in range(self._bands_count)]
+        self._profile_by_id = dict()
+        self._price_by_id = dict()
+
+    def __len__(self):
+        return len(self._price_by_id)
+
+    def load(self):
+        con = self._dbcon.get_read_connection()
+        self._clear()
+        with con:
+            rows = con.execute("select id, price, features, environments from resort_view")
+            for id_, price, features, environments in rows:
+                self.add(id_, price, json.loads(features), json.loads(environments))
+
+    def subscribe(self):
+        for dao_class in (ResortDAO, FeatureDAO, EnvironmentDAO):
+            dao = dao_class(self._dbcon)
+            if self not in dao._observers:
+                dao.attach(self)
+
+    def unsubscribe(self):
+        for dao_class in (ResortDAO, FeatureDAO, EnvironmentDAO):
+            dao = dao_class(self._dbcon)
+            if self in dao._observers:
+                dao.detach(self)
+
+    def _hash_row(self, token: int) -> list:
+        return [((a * token + b) % PRIME) & 0xffffffff for a, b in self._permutations]
+
+    def _token(self, kind: str, name: str) -> int:
+        token = self._tokens.get((kind, name))
+        if token is None:
+            token = self._tokens[(kind, name)] = len(self._hashes)
+            self._hashes.append(self._hash_row(token))
+        return token
+
+    def _tuple(self, features, environments) -> tuple:
+        tokens = {self._token("f", name) for name in features}
+        tokens.update(self._token("e", name) for name in environments)
+        return tuple(sorted(tokens))
+
+    def _query(self, features, environments) -> tuple:
+        # (tokens, signature) of a query without adding to the index: names it has not seen get
+        # tokens past the stored ones, which no profile contains
+        tokens = dict()
+        for kind, names in (("f", features), ("e", environments)):
+            for name in names:
+                token = self._tokens.get((kind, name))
+                tokens[(kind, name)] = len(self._hashes) + len(tokens) if token is None else token
+        rows = [self._hashes[token] if token < len(self._hashes) else self._hash_row(token)
+                for token in tokens.values()]
+        return set(tokens.values()), self._signature(rows)
+
+    def _signature(self, rows: list) -> list:
+        # element-wise minimum of the tokens' hash rows
+        if not rows:
+            return [0xffffffff] * self._num_perm
+        if len(rows) == 1:
+            return rows[0]
+        return list(map(min, *rows))
+
+    def _band_keys(self, signature) -> list:
+        rows = self._rows
+        return [hash(tuple(signature[band * rows:(band + 1) * rows])) for band in range(self._bands_count)]
+
+    def _stored_signature(self, profile: int):
+        return self._signatures[profile * self._num_perm:(profile + 1) * self._num_perm]
+
+    def _profile(self, tokens: tuple) -> int:
+        profile = self._profile_ids.get(tokens)
+        if profile is not None:
+            return profile
+        signature = self._signature([self._hashes[token] for token in tokens])
+        if self._free:
+            profile = self._free.pop()
+            self._profiles[profile] = tokens
+            self._signatures[profile * self._num_perm:(profile + 1) * self._num_perm] = array("I", signature)
+        else:
+            profile = len(self._profiles)
+            self._profiles.append(tokens)
+            self._members.append(list())
+            self._signatures.extend(signature)
+        self._profile_ids[tokens] = profile
+        for band, key in enumerate(self._band_keys(signature)):
+            self._bands[band].setdefault(key, list()).append(profile)
+        return profile
+
+    def _release(self, profile: int):
+        # an empty profile leaves the buckets and its slot is reused
+        for band, key in enumerate(self._band_keys(self._stored_signature(profile))):
+            bucket = self._bands[band][key]
+            bucket.remove(profile)
+            if not bucket:
+                del self._bands[band][key]
+        del self._profile_ids[self._profiles[profile]]
+        self._profiles[profile] = None
+        self._free.append(profile)
+
+    def _insert(self, id_: int, profile: int, price: float):
+        self._profile_by_id[id_] = profile
+        self._price_by_id[id_] = price
+        insort(self._members[profile], id_, key=self._price_by_id.__getitem__)
+
+    def add(self, id_: int, price: float, features=(), environments=()):
+        if id_ in self._price_by_id:
+            self.remove(id_)
+        self._insert(id_, self._profile(self._tuple(features, environments)), price)
+
+    def remove(self, id_: int):
+        if id_ not in self._price_by_id:
+            return
+        profile = self._profile_by_id.pop(id_)
+        members = self._members[profile]
+        members.remove(id_)
+        del self._price_by_id[id_]
+        if not members:
+            self._release(profile)
+
+    def set_price(self, id_: int, price: float):
+        if id_ not in self._price_by_id:
+            return
+        members = self._members[self._profile_by_id[id_]]
+        members.remove(id_)
+        self._price_by_id[id_] = price
+        insort(members, id_, key=self._price_by_id.__getitem__)
+
+    def _drop_token(self, kind: str, name: str):
+        # a removed feature/environment: its resorts move to the profile without it
+        token = self._tokens.pop((kind, name), None)
+        if token is None:
+            return
+        affected = [profile for profile, tokens in enumerate(self._profiles) if tokens and token in tokens]
+        for profile in affected:
+            tokens = tuple(other for other in self._profiles[profile] if other != token)
+            for id_ in list(self._members[profile]):
+                price = self._price_by_id[id_]
+                self.remove(id_)
+                self._insert(id_, self._profile(tokens), price)
+
+    def update(self, subject: Subject) -> None:
+        action = subject._last_action
+        if isinstance(subject, ResortDAO):
+            if action["action"] == "add":
+                resort = action["object"]
+                self.add(action["id"], resort.price, resort.feature_ids, resort.environment_ids)
+            elif action["action"] == "remove":
+                for id_ in action["ids"]:
+                    self.remove(id_)
+            elif action["action"] == "update":
+                for id_ in action["ids"]:
+                    self.set_price(id_, action["new"].price)
+            return
+
+        kind = "f" if isinstance(subject, FeatureDAO) else "e"
+        if action["action"] == "remove":
+            self._drop_token(kind, action["object"].name)
+        elif action["action"] == "update" and (kind, action["old"].name) in self._tokens:
+            self._tokens[(kind, action["new"].name)] = self._tokens.pop((kind, action["old"].name))
+
+    def _nearest(self, profile: int, price: float, k: int, exclude) -> list:
+        # up to k members of profile closest to price, as (distance, id)
+        members = self._members[profile]
+        right = bisect_left(members, price, key=self._price_by_id.__getitem__)
+        left = right - 1
+        found = list()
+        while len(found) < k and (left >= 0 or right < len(members)):
+            left_distance = price - self._price_by_id[members[left]] if left >= 0 else None
+            right_distance = self._price_by_id[members[right]] - price if right < len(members) else None
+            if right_distance is None or (left_distance is not None and left_distance <= right_distance):
+                id_, distance = members[left], left_distance
+                left -= 1
+            else:
+                id_, distance = members[right], right_distance
+                right += 1
+            if id_ != exclude:
+                found.append((distance, id_))
+        return found
+
+    def _rank(self, query: set, profiles, price: float, k: int, exclude) -> list:
+        # exact Jaccard over profiles, best first; price distance breaks ties
+        scored = list()
+        for profile in profiles:
+            tokens = self._profiles[profile]
+            common = len(query.intersection(tokens))
+            union = len(query) + len(tokens) - common
+            scored.append((common / union if union else 1.0, profile))
+        scored.sort(reverse=True)
+
+        found = list()
+        for position, (jaccard, profile) in enumerate(scored):
+            for distance, id_ in self._nearest(profile, price, k, exclude):
+                found.append((-jaccard, distance, id_))
+            # lower similarities cannot displace k results already found
+            if len(found) >= k and (position + 1 == len(scored) or scored[position + 1][0] < jaccard):
+                break
+        return [(-negative, self._price_by_id[id_], id_) for negative, _, id_ in heapq.nsmallest(k, found)]
+
+    def candidates(self, features=(), environments=()) -> set:
+        # profiles sharing at least one LSH band with the feature/environment set
+        _, signature = self._query(features, environments)
+        return self._candidates(signature)
+
+    def _candidates(self, signature) -> set:
+        found = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            found.update(self._bands[band].get(key, ()))
+        return found
+
+    def similar_to(self, features=(), environments=(), price: float = .0, k: int = 10, exclude: int = None) -> list:
+        # (jaccard, price, id) of up to k resorts, most similar first
+        tokens, signature = self._query(features, environments)
+        return self._rank(tokens, self._candidates(signature), price, k, exclude)
+
+    def similar(self, id_: int, k: int = 10) -> list:
+        # resorts like resort id_, excluding itself
+        profile = self._profile_by_id[id_]
+        tokens = self._profiles[profile]
+        found = set()
+        for band, key in enumerate(self._band_keys(self._stored_signature(profile))):
+            found.update(self._bands[band][key])
+        return self._rank(set(tokens), found, self._price_by_id[id_], k, id_)
+
+    def similar_exact(self, id_: int, k: int = 10) -> list:
+        # similar() over every profile; the quadratic baseline for recall
+        profiles = [profile for profile, tokens in enumerate(self._profiles) if tokens is not None]
+        query = set(self._profiles[self._profile_by_id[id_]])
+        return self._rank(query, profiles, self._price_by_id[id_], k, id_)
+
+    def memory_bytes(self) -> int:
+        size = self._signatures.buffer_info()[1] * self._signatures.itemsize
+        for index in (self._profile_by_id, self._price_by_id, self._profile_ids):
+            size += sys.getsizeof(index)
+        # boxed ids, prices and profile numbers held by the dicts
+        size += len(self._price_by_id) * (sys.getsizeof(2 ** 40) * 2 + sys.getsizeof(.0))
+        size += sys.getsizeof(self._profiles) + sys.getsizeof(self._members)
+        size += sum(sys.getsizeof(tokens) for tokens in self._profile_ids)
+        size += sum(sys.getsizeof(members) for members in self._members)
+        for buckets in self._bands:
+            size += sys.getsizeof(buckets) + sum(sys.getsizeof(bucket) for bucket in buckets.values())
+        return size
+
+    def memory_per_million(self) -> float:
+        if not self._price_by_id:
+            return .0
+        return self.memory_bytes() / len(self._price_by_id) * 1_000_000
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DataBaseConnection import CREATE_TABLES, MIGRATIONS, migrate, schema_version
+
+
+def baseline_database() -> sqlite3.Connection:
+    # the schema before migrations existed: base tables, user_version 0, roles seeded twice
+    con = sqlite3.connect(":memory:")
+    for statement in CREATE_TABLES:
+        con.execute(statement)
+    con.executemany("insert into roles (name) values (?)", [("admin",), ("user",), ("admin",), ("user",)])
+    con.executemany("insert into features (name) values (?)", [("spa",), ("golf",), ("spa",)])
+    con.executemany("insert into environments (name) values (?)", [("ocean",), ("ocean",)])
+    con.execute("insert into users (role_id, login, phash) values (3, 'adminusr', 'x')")
+    con.commit()
+    return con
+
+
+class UniqueNamesMigrationTest(unittest.TestCase):
+
+    def test_duplicates_merge_into_lowest_id(self):
+        con = baseline_database()
+        con.executemany("insert into resorts (name, price) values (?, ?)",
+                        [("rixos", 100.0), ("asteria", 50.0), ("rixos", 100.0)])
+        con.executemany("insert into resort_features (resort_id, feature_id) values (?, ?)",
+                        [(1, 3), (2, 1), (3, 2)])
+        con.executemany("insert into resort_environments (resort_id, environment_id) values (?, ?)",
+                        [(1, 2), (3, 1)])
+        con.commit()
+
+        migrate(con)
+
+        self.assertEqual(schema_version(con), len(MIGRATIONS))
+        self.assertEqual(con.execute("select id, name from features order by id").fetchall(),
+                         [(1, "spa"), (2, "golf")])
+        self.assertEqual(con.execute("select id, name from environments order by id").fetchall(), [(1, "ocean")])
+        self.assertEqual(con.execute("select id, name from roles order by id").fetchall(),
+                         [(1, "admin"), (2, "user")])
+        self.assertEqual(con.execute("select role_id from users").fetchall(), [(1,)])
+        self.assertEqual(con.execute("select id, name, price from resorts order by id").fetchall(),
+                         [(1, "rixos", 100.0), (2, "asteria", 50.0)])
+        self.assertEqual(con.execute("select resort_id, feature_id from resort_features order by 1, 2").fetchall(),
+                         [(1, 1), (1, 2), (2, 1)])
+        self.assertEqual(con.execute("select resort_id, environment_id from resort_environments").fetchall(),
+                         [(1, 1)])
+        self.assertEqual(con.execute("select features from resort_view where id = 1").fetchone(),
+                         ('["golf","spa"]',))
+        with self.assertRaises(sqlite3.IntegrityError):
+            con.execute("insert into features (name) values ('spa')")
+
+    def test_same_name_resorts_with_different_prices_abort(self):
+        con = baseline_database()
+        con.executemany("insert into resorts (name, price) values (?, ?)",
+                        [("rixos", 100.0), ("rixos", 5000.0), ("asteria", 50.0), ("asteria", 60.0)])
+        con.commit()
+
+        with self.assertRaises(sqlite3.IntegrityError) as raised:
+            migrate(con)
+
+        self.assertIn("asteria, rixos", str(raised.exception))
+        self.assertEqual(schema_version(con), len(MIGRATIONS) - 1)
+        self.assertEqual(con.execute("select name, price from resorts order by id").fetchall(),
+                         [("rixos", 100.0), ("rixos", 5000.0), ("asteria", 50.0), ("asteria", 60.0)])
+        self.assertEqual(con.execute("select count(*) from features").fetchone(), (3,))
+
+
+if __name__ == "__main__":
+    unittest.main()
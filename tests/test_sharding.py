@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Feature
+import Resort
+from DAOFactoryMethod import ResortDAO, FeatureDAO, ConcurrentUpdateError, retry_on_conflict
+from Sharding import ShardedDataBaseConnection
+
+
+class ShardedVersionedUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbcon = ShardedDataBaseConnection([os.path.join(self.directory, f"shard{i}.db") for i in range(3)])
+        self.dbcon.open_connection()
+        self.resorts = self.dbcon.create_DAO(ResortDAO)
+        self.resorts.add(Resort.Resort("rixos", 100.0))
+
+    def tearDown(self):
+        self.dbcon.close_connection()
+        shutil.rmtree(self.directory)
+
+    def price(self) -> float:
+        (_, _, price), = self.resorts.filter([{"column": "name", "value": "rixos", "op": "="}])
+        return price
+
+    def pinned(self, price: float) -> Resort.Resort:
+        (_, version), = self.resorts.versions([{"column": "name", "value": "rixos", "op": "="}])
+        return Resort.Resort("rixos", price, version=version)
+
+    def test_pinned_version_updates_the_owning_shard_only(self):
+        self.resorts.update(self.pinned(100.0), Resort.Resort("rixos", 200.0))
+
+        self.assertEqual(self.price(), 200.0)
+
+    def test_stale_version_conflicts_without_writing(self):
+        stale = self.pinned(100.0)
+        self.resorts.update(self.pinned(100.0), Resort.Resort("rixos", 200.0))
+
+        with self.assertRaises(ConcurrentUpdateError):
+            self.resorts.update(stale, Resort.Resort("rixos", 300.0))
+        self.assertEqual(self.price(), 200.0)
+
+    def test_retry_on_conflict_rereads_versions(self):
+        attempts = list()
+
+        def operation():
+            old = self.pinned(self.price())
+            if not attempts:
+                # another writer gets in between the read and the write
+                self.resorts.update(self.pinned(self.price()), Resort.Resort("rixos", 150.0))
+            attempts.append(old)
+            self.resorts.update(old, Resort.Resort("rixos", 250.0))
+
+        retry_on_conflict(operation, delay=0)
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.price(), 250.0)
+
+
+class ShardedReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbcon = ShardedDataBaseConnection([os.path.join(self.directory, f"shard{i}.db") for i in range(3)])
+        self.dbcon.open_connection()
+        self.dbcon.create_DAO(FeatureDAO).add(Feature.Feature("spa"))
+        self.resorts = self.dbcon.create_DAO(ResortDAO)
+        for i in range(12):
+            self.resorts.add(Resort.Resort(f"resort {i}", float(i), {"spa"} if i % 2 else set()))
+
+    def tearDown(self):
+        self.dbcon.close_connection()
+        shutil.rmtree(self.directory)
+
+    def test_streamed_reads_cover_every_shard_in_id_order(self):
+        ids = [id_ for id_, _, _ in self.resorts.get_all()]
+        self.assertEqual(len({id_ >> 40 for id_ in ids}), 3)
+
+        rows = list(self.resorts.iterate_with_names(batch_size=2))
+        self.assertEqual([row[0] for row in rows], ids)
+        self.assertEqual(rows, self.resorts.get_all_view())
+
+        objects = json.loads(self.resorts.get_all_json())
+        self.assertEqual([item["id"] for item in objects], ids)
+        self.assertEqual(json.loads(b"".join(self.resorts.iterate_json(chunk_rows=2))), objects)
+        self.assertEqual(self.resorts.filter_json([{"column": "price", "value": 100.0, "op": ">"}]), b"[]")
+
+    def test_search_merges_shard_results(self):
+        found = self.resorts.search("resort", limit=5)
+
+        self.assertEqual(len(found), 5)
+        self.assertEqual(len({id_ >> 40 for id_, _, _ in found}), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()